@@ -0,0 +1,209 @@
+#!python
+
+import os
+import sys
+import math
+import random
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from importer import Importer
+from osgeo import ogr, osr
+
+
+class Generator():
+    """ Writes synthetic VicMap layers, using the column names and types from the column mappings
+    and the dataset and table names from the table mappings
+    """
+
+    # Layouts based on real VicMap layers. Columns which aren't in the column mappings are ignored.
+    LAYOUTS = {
+        'point': {'dataset': 'vmadd', 'table': 'address', 'geometry': ogr.wkbPoint,
+                  'columns': ['PFI', 'UFI', 'EZI_ADD', 'STATE', 'LOCALITY', 'ROAD_NAME', 'ROAD_TYPE', 'HSE_NUM1',
+                              'HSE_NUM2', 'HSE_SUF1', 'LGA_CODE', 'BUNIT_ID1', 'FLOOR_NO_1', 'BLGUNTTYP', 'ADD_CLASS',
+                              'PR_PFI', 'PFI_CR', 'UFI_CR']},
+        'line': {'dataset': 'vmtrans', 'table': 'tr_road', 'geometry': ogr.wkbLineString,
+                 'columns': ['PFI', 'UFI', 'EZIRDNMLBL', 'ROAD_NAME', 'ROAD_TYPE', 'DIRECTION', 'CLASS_CODE', 'LEFT_LOC',
+                             'RIGHT_LOC', 'FROM_UFI', 'TO_UFI', 'FTYPE_CODE', 'PFI_CR', 'UFI_CR']},
+        'polygon': {'dataset': 'vmprop', 'table': 'parcel_view', 'geometry': ogr.wkbMultiPolygon,
+                    'columns': ['PFI', 'UFI', 'VIEW_PFI', 'BASE_PFI', 'SPI', 'LOT_NUMBER', 'PLAN_NO', 'TOWNSHIP',
+                                'CLASS_CODE', 'FTYPE_CODE', 'LGA_CODE', 'PARCEL_PFI', 'PFI_CR', 'UFI_CR']},
+        'table': {'dataset': 'vmprop', 'table': 'parcel_property', 'geometry': ogr.wkbNone,
+                  'columns': ['PFI', 'UFI', 'PR_PFI', 'PARCEL_PFI', 'PFI_CR', 'UFI_CR']}
+    }
+
+    # Approximate extent of Victoria, in GDA94 longitude/latitude
+    EXTENT = (141.0, -39.1, 149.9, -34.1)
+
+    STATES = ['VIC', 'NSW', 'SA']
+
+    def __init__(self, importer, seed=1):
+        self.importer = importer
+        self.seed = seed
+
+    def columns(self, layout, extra_columns=0):
+        """ Returns the column mappings for the columns of a layout, plus the specified number of
+        extra columns from the column mappings
+        """
+        l = self.LAYOUTS[layout]
+        dest_schema, dest_table = self.importer.destTable(l['dataset'], l['table'])
+        names = list(l['columns'])
+        if extra_columns:
+            candidates = sorted(set([m['column_name_10'].upper() for m in self.importer.columnMappings]) - set(names))
+            names.extend(candidates[:extra_columns])
+
+        columns = []
+        for n in names:
+            m = self.importer.getMappedColumnDef(dest_schema, dest_table, n)
+            # transforms other than the state column expect source values which can't be generated
+            if m and ('transform' not in m.keys() or n == 'STATE'):
+                columns.append((n, m))
+        return columns
+
+    def fieldDefinition(self, name, data_type):
+        """ Returns an OGR field definition matching a mapped column data type """
+        if data_type in ('bigint',):
+            defn = ogr.FieldDefn(name, ogr.OFTInteger64)
+            defn.SetWidth(18)
+        elif data_type in ('integer', 'int'):
+            defn = ogr.FieldDefn(name, ogr.OFTInteger)
+            defn.SetWidth(9)
+        elif data_type in ('real', 'double precision', 'numeric'):
+            defn = ogr.FieldDefn(name, ogr.OFTReal)
+            defn.SetWidth(19)
+            defn.SetPrecision(8)
+        elif data_type == 'date':
+            defn = ogr.FieldDefn(name, ogr.OFTDate)
+        elif data_type.startswith('character varying('):
+            defn = ogr.FieldDefn(name, ogr.OFTString)
+            defn.SetWidth(int(data_type[len('character varying('):-1]))
+        elif data_type == 'vicmap.state':
+            defn = ogr.FieldDefn(name, ogr.OFTString)
+            defn.SetWidth(3)
+        else:
+            defn = ogr.FieldDefn(name, ogr.OFTString)
+            defn.SetWidth(50)
+        return defn
+
+    def value(self, rnd, i, name, defn, data_type):
+        """ Returns a synthetic value for a field of the i'th feature """
+        if name in ('PFI', 'UFI'):
+            # unique identifiers
+            return (1 if name == 'PFI' else 2) * 10000000 + i
+        field_type = defn.GetType()
+        if field_type in (ogr.OFTInteger, ogr.OFTInteger64):
+            return rnd.randint(1, 999999)
+        elif field_type == ogr.OFTReal:
+            return round(rnd.uniform(0, 10000), 4)
+        elif field_type == ogr.OFTDate:
+            d = datetime.date(2000, 1, 1) + datetime.timedelta(days=rnd.randint(0, 7000))
+            return d.strftime('%Y/%m/%d')
+        elif data_type == 'vicmap.state':
+            return rnd.choice(self.STATES)
+        elif data_type == 'boolean':
+            return rnd.choice('YN')
+        elif defn.GetWidth() <= 3:
+            # short code columns have a small set of values
+            return ''.join([rnd.choice('ABCDE') for c in range(defn.GetWidth())])
+        else:
+            return '{} {}'.format(name.lower(), rnd.randint(1, 5000))
+
+    def geometry(self, rnd, geometry_type, vertices, parts):
+        """ Returns a random geometry within Victoria """
+        x = rnd.uniform(self.EXTENT[0], self.EXTENT[2])
+        y = rnd.uniform(self.EXTENT[1], self.EXTENT[3])
+        if geometry_type == ogr.wkbPoint:
+            geom = ogr.Geometry(ogr.wkbPoint)
+            geom.AddPoint_2D(x, y)
+        elif geometry_type == ogr.wkbLineString:
+            geom = ogr.Geometry(ogr.wkbLineString)
+            for v in range(max(vertices, 2)):
+                geom.AddPoint_2D(x, y)
+                x += rnd.uniform(-0.0005, 0.0005)
+                y += rnd.uniform(-0.0005, 0.0005)
+        else:
+            geom = ogr.Geometry(ogr.wkbMultiPolygon)
+            for p in range(parts):
+                ring = ogr.Geometry(ogr.wkbLinearRing)
+                cx = x + p * 0.002
+                for v in range(max(vertices, 3)):
+                    angle = 2 * math.pi * v / max(vertices, 3)
+                    radius = 0.0005 * rnd.uniform(0.7, 1.0)
+                    ring.AddPoint_2D(cx + radius * math.cos(angle), y + radius * math.sin(angle))
+                ring.CloseRings()
+                polygon = ogr.Geometry(ogr.wkbPolygon)
+                polygon.AddGeometry(ring)
+                geom.AddGeometry(polygon)
+        return geom
+
+    def layerPath(self, layout, folder):
+        """ Returns the path a layout is written to, following the VicMap folder structure
+        (eg folder/VMADD/layer/address.shp)
+        """
+        l = self.LAYOUTS[layout]
+        if l['geometry'] == ogr.wkbNone:
+            return os.path.join(folder, l['dataset'].upper(), 'table', '{}.dbf'.format(l['table']))
+        return os.path.join(folder, l['dataset'].upper(), 'layer', '{}.shp'.format(l['table']))
+
+    def generate(self, layout, count, folder, vertices=10, parts=1, extra_columns=0):
+        """ Writes a synthetic layer with count features to folder, returning the path of the
+        written layer
+        """
+        l = self.LAYOUTS[layout]
+        rnd = random.Random(self.seed)
+        spatial = l['geometry'] != ogr.wkbNone
+        path = self.layerPath(layout, folder)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        data_source = driver.CreateDataSource(path)
+        srs = None
+        if spatial:
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(4283)
+        layer = data_source.CreateLayer(l['table'], srs, l['geometry'])
+
+        fields = []
+        for name, m in self.columns(layout, extra_columns):
+            defn = self.fieldDefinition(name, m['data_type'])
+            layer.CreateField(defn)
+            fields.append((name, defn, m['data_type']))
+
+        layer_defn = layer.GetLayerDefn()
+        for i in range(count):
+            f = ogr.Feature(layer_defn)
+            for name, defn, data_type in fields:
+                f.SetField(name, self.value(rnd, i, name, defn, data_type))
+            if spatial:
+                f.SetGeometry(self.geometry(rnd, l['geometry'], vertices, parts))
+            layer.CreateFeature(f)
+
+        data_source = None
+        return path
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Generates synthetic VicMap layers for benchmarking')
+    parser.add_argument('folder', help='Folder to write the generated datasets to')
+    parser.add_argument('layout', choices=sorted(Generator.LAYOUTS.keys()),
+                        help='Layout of the generated layer')
+    parser.add_argument('count', type=int, help='Number of features to generate')
+    parser.add_argument('--vertices', type=int, default=10,
+                        help='Number of vertices for each line or polygon ring')
+    parser.add_argument('--parts', type=int, default=1,
+                        help='Number of polygons in each multipolygon')
+    parser.add_argument('--extra-columns', type=int, default=0,
+                        help='Number of extra columns from the column mappings to add')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+
+    g = Generator(Importer(None), args.seed)
+    print 'Wrote {}'.format(g.generate(args.layout, args.count, args.folder,
+                                       args.vertices, args.parts, args.extra_columns))
@@ -0,0 +1,163 @@
+#!python
+
+import os
+import sys
+import argparse
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from database import Database
+from importer import Importer
+from scheduler import Scheduler
+from generate import Generator
+
+
+class Benchmark():
+    """ Imports generated layers of increasing size into a throwaway database, recording
+    the timings for each import phase
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.database = 'vicmap2pgsql_bench_{}'.format(os.getpid())
+        self.records = []
+
+    def settings(self):
+        """ Returns the importer settings given on the command line as name=value pairs """
+        settings = {}
+        for s in self.args.setting or []:
+            name, value = s.split('=', 1)
+            if value.lower() in ('true', 'false'):
+                value = value.lower() == 'true'
+            elif value.isdigit():
+                value = int(value)
+            settings[name.replace('-', '_')] = value
+        return settings
+
+    def createDatabase(self):
+        """ Creates the throwaway database on the server given by the PG* environment variables """
+        with Database() as db:
+            db.runSqlNoTransaction('CREATE DATABASE "{}"'.format(self.database))
+        os.environ['PGDATABASE'] = self.database
+        with Database() as db:
+            db.runSqlNoTransaction('CREATE EXTENSION IF NOT EXISTS postgis')
+
+    def dropDatabase(self, server_database):
+        """ Drops the throwaway database """
+        if server_database:
+            os.environ['PGDATABASE'] = server_database
+        else:
+            del os.environ['PGDATABASE']
+        with Database() as db:
+            db.runSqlNoTransaction('DROP DATABASE IF EXISTS "{}"'.format(self.database))
+
+    def generate(self, layout, size):
+        """ Generates a layer of the given size, reusing previously generated data if it was
+        generated with the same options
+        """
+        folder = os.path.join(self.args.data_dir, '{}_{}_{}_{}_{}_{}'.format(
+            layout, size, self.args.vertices, self.args.parts, self.args.extra_columns, self.args.seed))
+        g = Generator(Importer(None, self.args.mapping_cache), self.args.seed)
+        layer = g.layerPath(layout, folder)
+        if not os.path.isfile(layer):
+            print 'Generating {} {} features'.format(size, layout)
+            start = time.time()
+            g.generate(layout, size, folder, self.args.vertices, self.args.parts, self.args.extra_columns)
+            print 'Generated in {:.1f}s'.format(time.time() - start)
+        return {'dataset': g.LAYOUTS[layout]['dataset'], 'layer': layer}
+
+    def importLayer(self, layout, size, layer):
+        """ Imports a generated layer once for each requested run. The first run creates the
+        destination table, and later runs reload it.
+        """
+        for run in range(self.args.runs):
+            i = Importer(Database(), self.args.mapping_cache)
+            i.applySettings(self.settings())
+            i.recreate = run == 0
+            i.force = True
+            i.metrics_file = self.args.metrics_file
+            if run == 0:
+                i.setupDatabase()
+            try:
+                failures = Scheduler(i).run([layer])
+            finally:
+                i.db.closeConnection()
+            record = i.metrics.lastRecord
+            if failures or not record or record['status'] != 'imported':
+                raise Exception('Import of {} {} features failed'.format(size, layout))
+            record.update({'layout': layout, 'size': size, 'run': run})
+            self.records.append(record)
+
+    def report(self):
+        """ Prints a table of the timings for each phase """
+        phases = []
+        for r in self.records:
+            for p in r['phases']:
+                if p['phase'] not in phases:
+                    phases.append(p['phase'])
+
+        header = ['layout', 'size', 'run', 'rows/s', 'total'] + phases
+        print '\n' + '\t'.join(header)
+        for r in self.records:
+            seconds = dict([(p['phase'], p['seconds']) for p in r['phases']])
+            row = [r['layout'], str(r['size']), str(r['run']),
+                   str(round(r['rows'] / r['seconds'], 1) if r['seconds'] else ''),
+                   str(r['seconds'])] + [str(seconds.get(p, '')) for p in phases]
+            print '\t'.join(row)
+
+    def run(self):
+        server_database = os.getenv('PGDATABASE')
+        self.createDatabase()
+        try:
+            for layout in self.args.layouts:
+                for size in self.args.sizes:
+                    self.importLayer(layout, size, self.generate(layout, size))
+        finally:
+            if self.args.keep_database:
+                print '\nKept benchmark database {}'.format(self.database)
+            else:
+                self.dropDatabase(server_database)
+            self.report()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks importing synthetic VicMap layers into a throwaway database')
+    parser.add_argument('--layouts', nargs='+', default=['point', 'line', 'polygon'],
+                        choices=sorted(Generator.LAYOUTS.keys()),
+                        help='Layouts of the generated layers')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000, 10000000],
+                        help='Number of features in the generated layers')
+    parser.add_argument('--vertices', type=int, default=10,
+                        help='Number of vertices for each line or polygon ring')
+    parser.add_argument('--parts', type=int, default=1,
+                        help='Number of polygons in each multipolygon')
+    parser.add_argument('--extra-columns', type=int, default=0,
+                        help='Number of extra columns from the column mappings to add to each layer')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the generated data')
+    parser.add_argument('--runs', type=int, default=2,
+                        help='Number of times to import each layer. The first run creates the table, later runs reload it.')
+    parser.add_argument('--setting', action='append',
+                        help='Importer setting to use, as name=value, eg direct=true or defer_indexes=true. Can be repeated.')
+    parser.add_argument('--data-dir',
+                        help='Directory for the generated layers, which are reused between benchmarks. Defaults to a temporary directory.')
+    parser.add_argument('--mapping-cache',
+                        help='Directory for caching the compiled table and column mappings.')
+    parser.add_argument('--metrics-file',
+                        help='Appends the metrics for each import to this file as JSON lines.')
+    parser.add_argument('--keep-database', action='store_true', default=False,
+                        help='Keeps the benchmark database after the run.')
+    args = parser.parse_args()
+
+    temp_dir = None
+    if not args.data_dir:
+        temp_dir = args.data_dir = tempfile.mkdtemp(prefix='vicmap2pgsql_bench_')
+    try:
+        Benchmark(args).run()
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
@@ -0,0 +1,12 @@
+CREATE SCHEMA IF NOT EXISTS vicmap;
+
+-- Fingerprints of the source files and mappings used for each imported layer
+CREATE TABLE IF NOT EXISTS vicmap.import_manifest (
+	dataset text NOT NULL,
+	layer text NOT NULL,
+	dest_schema text NOT NULL,
+	dest_table text NOT NULL,
+	fingerprint text NOT NULL,
+	imported timestamp with time zone NOT NULL DEFAULT now(),
+	PRIMARY KEY (dataset, layer)
+);
@@ -0,0 +1,12 @@
+CREATE SCHEMA IF NOT EXISTS vicmap;
+
+-- Progress of each layer in the current import run, used to resume interrupted runs
+CREATE TABLE IF NOT EXISTS vicmap.import_journal (
+	dataset text NOT NULL,
+	layer text NOT NULL,
+	phase text NOT NULL,
+	staging_schema text,
+	fingerprint text,
+	updated timestamp with time zone NOT NULL DEFAULT now(),
+	PRIMARY KEY (dataset, layer)
+);
@@ -0,0 +1,45 @@
+CREATE SCHEMA IF NOT EXISTS vicmap;
+
+-- Casts used to load columns whose types were narrowed from numeric to integers. Unlike a
+-- plain cast these fail, instead of rounding, if a later import contains fractional values.
+CREATE OR REPLACE FUNCTION vicmap.narrow_integer(value numeric) RETURNS integer AS $$
+BEGIN
+	IF value <> trunc(value) THEN
+		RAISE EXCEPTION 'Cannot narrow % to integer', value;
+	END IF;
+	RETURN value::integer;
+END
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION vicmap.narrow_bigint(value numeric) RETURNS bigint AS $$
+BEGIN
+	IF value <> trunc(value) THEN
+		RAISE EXCEPTION 'Cannot narrow % to bigint', value;
+	END IF;
+	RETURN value::bigint;
+END
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
+
+-- Converts YYYYMMDD, YYYY-MM-DD or YYYY/MM/DD text to a date. Used to load columns whose types
+-- were narrowed from text to dates, failing if a later import contains any other text (eg 20230231
+-- or 03/04/2023), which a plain cast would interpret using the DateStyle setting. With raise_invalid
+-- false it returns NULL instead, to test whether text columns can be narrowed.
+DROP FUNCTION IF EXISTS vicmap.narrow_date(text);
+CREATE OR REPLACE FUNCTION vicmap.narrow_date(value text, raise_invalid boolean DEFAULT true) RETURNS date AS $$
+DECLARE
+	parts text[];
+	first_day date;
+BEGIN
+	parts := regexp_match(value, '^([0-9]{4})([-/]?)(0[1-9]|1[0-2])\2(0[1-9]|[12][0-9]|3[01])$');
+	IF parts IS NOT NULL AND parts[1]::integer > 0 THEN
+		first_day := make_date(parts[1]::integer, parts[3]::integer, 1);
+		IF parts[4]::integer <= extract(day FROM first_day + interval '1 month' - interval '1 day') THEN
+			RETURN first_day + (parts[4]::integer - 1);
+		END IF;
+	END IF;
+	IF raise_invalid THEN
+		RAISE EXCEPTION 'Cannot narrow % to date', value;
+	END IF;
+	RETURN NULL;
+END
+$$ LANGUAGE plpgsql IMMUTABLE STRICT;
@@ -0,0 +1,19 @@
+CREATE SCHEMA IF NOT EXISTS vicmap;
+
+-- Statistics calculated by validating each imported layer's destination table
+CREATE TABLE IF NOT EXISTS vicmap.import_statistics (
+	dataset text NOT NULL,
+	layer text NOT NULL,
+	dest_schema text NOT NULL,
+	dest_table text NOT NULL,
+	rows bigint NOT NULL,
+	null_geometries bigint,
+	empty_geometries bigint,
+	invalid_geometries bigint,
+	repaired_geometries bigint,
+	duplicate_keys bigint,
+	extent text,
+	validated timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS import_statistics_layer_idx ON vicmap.import_statistics (dataset, layer, validated);
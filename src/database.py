@@ -1,5 +1,6 @@
 #!python
 
+from contextlib import contextmanager
 import os
 import psycopg2
 
@@ -15,6 +16,10 @@ class Database():
         self.password = 'password'
         self.getParamsFromEnv()
         self.c = self.createConnection()
+        # cached column metadata for tables, see tableCatalog()
+        self.catalog = {}
+        # number of nested transaction() blocks currently open
+        self.transaction_depth = 0
 
     def __del__(self):
         try:
@@ -64,18 +69,77 @@ class Database():
         cursor.execute(sql)
         r = cursor.fetchall()
         cursor.close()
+        # end the transaction opened by the query, so the connection doesn't sit idle in a
+        # transaction holding locks on the tables it read (eg while waiting to stage a layer)
+        self.commit()
         return r
 
+    @contextmanager
+    def transaction(self):
+        """Runs all of the queries made inside the block in a single transaction, which is committed
+           when the block ends, or rolled back if it raises an exception. Blocks can be nested, in which
+           case only the outermost block commits. Queries which can't run inside a transaction block
+           (eg VACUUM) must be made after the block.
+        """
+        self.transaction_depth += 1
+        try:
+            yield self
+        except:
+            self.transaction_depth -= 1
+            if not self.transaction_depth:
+                self.c.rollback()
+                # the cache may describe tables created or altered by the rolled back queries
+                self.invalidateCatalog()
+            raise
+        self.transaction_depth -= 1
+        if not self.transaction_depth:
+            self.c.commit()
+
+    def commit(self):
+        """Commits the current transaction, unless inside a transaction() block"""
+        if not self.transaction_depth:
+            self.c.commit()
+
     def runSql(self, sql):
         """Executes a SQL query"""
         cursor = self.c.cursor()
         cursor.execute(sql)
-        self.c.commit()
+        self.commit()
         cursor.close()
         return True
 
+    def runSqlBatch(self, statements):
+        """Executes a list of SQL queries in a single round trip and a single transaction"""
+        return self.runSql(';'.join(statements)) if statements else True
+
+    def sqlIsValid(self, sql):
+        """Tests whether a SQL query can be executed without error. Any changes made by the query are rolled back."""
+        cursor = self.c.cursor()
+        if self.transaction_depth:
+            # only roll back to here, keeping the changes made earlier in the transaction() block
+            cursor.execute('SAVEPOINT vicmap2pgsql_sql_is_valid')
+        try:
+            cursor.execute(sql)
+            return True
+        except psycopg2.Error:
+            return False
+        finally:
+            if self.transaction_depth:
+                cursor.execute('ROLLBACK TO SAVEPOINT vicmap2pgsql_sql_is_valid')
+            else:
+                self.c.rollback()
+            cursor.close()
+
+    def advisoryLock(self, name):
+        """Waits for an advisory lock on a name, which is held until the end of the current
+           transaction() block. Stops concurrent imports from making the same changes.
+        """
+        assert self.transaction_depth, 'Advisory locks must be taken inside a transaction() block'
+        return self.runSql("SELECT pg_advisory_xact_lock(hashtext('{}'))".format(self.encodeLiteral(name)))
+
     def runSqlNoTransaction(self, sql):
         """Executes a SQL query outside of a transaction block"""
+        assert not self.transaction_depth, 'Can not execute a query outside of a transaction inside a transaction() block'
         self.c.autocommit = True
         cursor = self.c.cursor()
         cursor.execute(sql)
@@ -92,18 +156,83 @@ class Database():
 
     def tableHasColumn(self, schema, table, column):
         """Tests whether a table has a specified column"""
-        res = self.fetchSqlRecords(
-            "select count(*) from information_schema.columns c where c.table_schema = '{}' and c.table_name='{}' and c.column_name='{}'".format(schema, table, column))
-        return res[0][0] > 0
+        return column in [c['name'] for c in self.tableCatalog(schema, table)]
 
-    def createTable(self, schema, table, cols):
+    def tableCatalog(self, schema, table):
+        """Returns the column metadata for a table, as a list of dicts with the column name, type,
+           max_length, precision, scale and full definition (eg 'geometry(MultiPolygon,3111)').
+           The metadata for all columns is fetched in a single query and cached until the table
+           is altered through this connection. Nothing is cached for tables which don't exist.
+        """
+        key = (schema, table)
+        if key not in self.catalog:
+            columns = self.fetchSqlRecords(
+                "select a.attname, format_type(a.atttypid, NULL), "
+                "case when a.atttypid in ('bpchar'::regtype, 'varchar'::regtype) and a.atttypmod > 0 then a.atttypmod - 4 end, "
+                "case when a.atttypid = 'numeric'::regtype and a.atttypmod > 0 then ((a.atttypmod - 4) >> 16) & 65535 end, "
+                "case when a.atttypid = 'numeric'::regtype and a.atttypmod > 0 then (a.atttypmod - 4) & 65535 end, "
+                "format_type(a.atttypid, a.atttypmod) "
+                "from pg_attribute a where a.attrelid = to_regclass('{}') and a.attnum > 0 and not a.attisdropped "
+                "order by a.attnum".format(self.encodeLiteral(self.encodeTableName(schema, table))))
+            if not columns:
+                return []
+            self.catalog[key] = [dict(zip(('name', 'type', 'max_length', 'precision', 'scale', 'definition'), c))
+                                 for c in columns]
+        return self.catalog[key]
+
+    def invalidateCatalog(self, schema=None, table=None):
+        """Removes cached column metadata for a table, or for all tables in a schema if table
+           is not specified, or for all tables if neither is specified. Must be called after altering
+           tables outside of this class (eg using ogr2ogr).
+        """
+        for key in list(self.catalog.keys()):
+            if (schema is None or key[0] == schema) and (table is None or key[1] == table):
+                del self.catalog[key]
+
+    def createTable(self, schema, table, cols, partition_by=None):
         """Creates a new table in the database, with specified columns.
            param cols is an array of [name, definition, extra defs (eg PRIMARY KEY)]
+           param partition_by creates a partitioned table, eg 'LIST ("source_layer")'
         """
         col_definition = ','.join(
             ['"{}" {} {}'.format(c[0], c[1], c[2]) for c in cols])
 
-        return self.runSql('CREATE TABLE {} ({})'.format(self.encodeTableName(schema, table), col_definition))
+        self.invalidateCatalog(schema, table)
+        return self.runSql('CREATE TABLE {} ({}){}'.format(self.encodeTableName(schema, table), col_definition,
+                                                           ' PARTITION BY {}'.format(partition_by) if partition_by else ''))
+
+    def tableIsPartitioned(self, schema, table):
+        """Tests whether a table is a partitioned table"""
+        r = self.fetchSqlRecords("SELECT relkind = 'p' FROM pg_class WHERE oid = '{}'::regclass".format(
+            self.encodeLiteral(self.encodeTableName(schema, table))))
+        return r[0][0]
+
+    def createPartition(self, schema, table, partition, column, value):
+        """Creates an empty table matching a list partitioned table, which can be loaded and indexed
+           before it is attached as the partition for a value of the partition column using attachPartition.
+           The partition column defaults to the value, and a check constraint on the value allows the
+           table to be attached without scanning it.
+        """
+        name = self.encodeTableName(schema, partition)
+        column = self.encodeColumnName(column)
+        value = self.encodeLiteral(value)
+        self.invalidateCatalog(schema, partition)
+        return self.runSqlBatch([
+            'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)'.format(name, self.encodeTableName(schema, table)),
+            "ALTER TABLE {} ALTER COLUMN {} SET DEFAULT '{}'".format(name, column, value),
+            "ALTER TABLE {} ADD CONSTRAINT partition_check CHECK ({} = '{}')".format(name, column, value)])
+
+    def attachPartition(self, schema, table, partition, value):
+        """Attaches a table as the partition of a list partitioned table for a value. Indexes on the
+           partitioned table which the partition doesn't already have are built.
+        """
+        return self.runSql("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ('{}')".format(
+            self.encodeTableName(schema, table), self.encodeTableName(schema, partition), self.encodeLiteral(value)))
+
+    def detachPartition(self, schema, table, partition):
+        """Detaches a partition from a partitioned table, leaving it as a separate table"""
+        return self.runSql('ALTER TABLE {} DETACH PARTITION {}'.format(
+            self.encodeTableName(schema, table), self.encodeTableName(schema, partition)))
 
     def setTableComment(self, schema, table, comment):
         """Sets the comment for the specified table
@@ -113,28 +242,226 @@ class Database():
     def dropTable(self, schema, table, cascade=False):
         """ Drops a table from the database """
         if cascade:
+            # dependent objects may also be dropped
+            self.invalidateCatalog()
             return self.runSql('DROP TABLE IF EXISTS {} CASCADE'.format(self.encodeTableName(schema, table)))
         else:
+            self.invalidateCatalog(schema, table)
             return self.runSql('DROP TABLE IF EXISTS {}'.format(self.encodeTableName(schema, table)))
 
+    def moveTable(self, schema, table, new_schema):
+        """ Moves a table to another schema """
+        self.invalidateCatalog(schema, table)
+        self.invalidateCatalog(new_schema, table)
+        return self.runSql('ALTER TABLE {} SET SCHEMA {}'.format(
+            self.encodeTableName(schema, table), self.encodeSchemaName(new_schema)))
+
+    def swapTable(self, schema, table, shadow_table):
+        """ Replaces a table with a shadow table in a single short transaction. The old table is
+            dropped, and the shadow table and its indexes, constraints and sequences are renamed to match.
+        """
+        renames = []
+        for i in self.getIndexDefinitions(schema, shadow_table):
+            if not i['name'].startswith(shadow_table):
+                continue
+            new_name = table + i['name'][len(shadow_table):]
+            if i['constraint']:
+                renames.append('ALTER TABLE {} RENAME CONSTRAINT {} TO {}'.format(
+                    self.encodeTableName(schema, table), self.encodeColumnName(i['name']), self.encodeColumnName(new_name)))
+            else:
+                renames.append('ALTER INDEX {} RENAME TO {}'.format(
+                    self.encodeTableName(schema, i['name']), self.encodeColumnName(new_name)))
+        for s in self.getOwnedSequences(schema, shadow_table):
+            if s.startswith(shadow_table):
+                renames.append('ALTER SEQUENCE {} RENAME TO {}'.format(
+                    self.encodeTableName(schema, s), self.encodeColumnName(table + s[len(shadow_table):])))
+
+        self.invalidateCatalog(schema, table)
+        self.invalidateCatalog(schema, shadow_table)
+        sql = ['DROP TABLE {}'.format(self.encodeTableName(schema, table)),
+               'ALTER TABLE {} RENAME TO {}'.format(self.encodeTableName(schema, shadow_table), self.encodeColumnName(table))]
+        return self.runSql(';'.join(sql + renames))
+
+    def getDependentObjects(self, schema, table):
+        """ Returns descriptions of the objects (eg views or foreign keys on other tables) which depend
+            on a table, and would prevent it from being dropped without cascading
+        """
+        r = self.fetchSqlRecords(
+            "select distinct pg_describe_object(d.classid, d.objid, 0) from pg_depend d "
+            "left join pg_rewrite w on d.classid = 'pg_rewrite'::regclass and w.oid = d.objid "
+            "left join pg_constraint c on d.classid = 'pg_constraint'::regclass and c.oid = d.objid "
+            "where d.refclassid = 'pg_class'::regclass and d.refobjid = '{0}'::regclass and d.deptype = 'n' "
+            "and w.ev_class is distinct from d.refobjid and c.conrelid is distinct from d.refobjid".format(
+                self.encodeLiteral(self.encodeTableName(schema, table))))
+        return sorted([row[0] for row in r])
+
+    def getOwnedSequences(self, schema, table):
+        """ Returns the names of sequences owned by a table's columns, eg for serial columns """
+        r = self.fetchSqlRecords(
+            "select s.relname from pg_depend d join pg_class s on s.oid = d.objid and s.relkind = 'S' "
+            "where d.classid = 'pg_class'::regclass and d.refobjid = '{}'::regclass and d.deptype = 'a'".format(
+                self.encodeLiteral(self.encodeTableName(schema, table))))
+        return [row[0] for row in r]
+
+    def copyTablePrivileges(self, schema, table, dest_table):
+        """ Grants the privileges held on a table to another table """
+        r = self.fetchSqlRecords(
+            "select case when a.grantee = 0 then 'PUBLIC' else quote_ident(r.rolname) end, a.privilege_type, a.is_grantable "
+            "from pg_class c cross join lateral aclexplode(c.relacl) a left join pg_roles r on r.oid = a.grantee "
+            "where c.oid = '{}'::regclass".format(self.encodeLiteral(self.encodeTableName(schema, table))))
+        sql = ['GRANT {} ON {} TO {}{}'.format(privilege, self.encodeTableName(schema, dest_table), grantee,
+                                              ' WITH GRANT OPTION' if grantable else '')
+               for grantee, privilege, grantable in r]
+        return self.runSqlBatch(sql)
+
     def truncateTable(self, schema, table):
         """ Truncates a table from the database """
+        self.invalidateCatalog(schema, table)
         return self.runSql('TRUNCATE TABLE {}'.format(self.encodeTableName(schema, table)))
 
     def getTableColumnDefs(self, schema, table):
         """ Gets the column definitions for the specified table """
-        src_columns = self.fetchSqlRecords(
-            "select c.column_name, data_type, character_maximum_length, numeric_precision, numeric_scale from information_schema.columns c where c.table_schema = '{}' and c.table_name='{}'".format(schema, table))
-        return [dict(zip(('name', 'type', 'max_length', 'precision', 'scale'), c)) for c in src_columns]
+        return [dict(c) for c in self.tableCatalog(schema, table)]
 
     def getGeometryColumnDef(self, schema, table, column):
         """ Returns the definition of a geometry column """
-        defs = self.fetchSqlRecords(
-            "select type, srid from geometry_columns where f_table_schema='{}' and f_table_name='{}' and f_geometry_column='{}'".format(schema, table, column))
+        defs = [c for c in self.tableCatalog(schema, table) if c['name'] == column and c['type'].endswith('geometry')]
         if not len(defs) == 1:
             return None
 
-        return 'geometry({},{})'.format(defs[0][0], defs[0][1])
+        return defs[0]['definition']
+
+    def createGeneralizedTable(self, schema, table, gen_table, column, geom_def, tolerance):
+        """Creates a copy of a table with its geometries simplified to a tolerance"""
+        columns = [self.encodeColumnName(c['name']) for c in self.tableCatalog(schema, table) if c['name'] != column]
+        columns.append('ST_SimplifyPreserveTopology({0}, {1})::{2} AS {0}'.format(self.encodeColumnName(column), tolerance, geom_def))
+        self.invalidateCatalog(schema, gen_table)
+        return self.runSql('CREATE TABLE {} AS SELECT {} FROM {} WHERE {} IS NOT NULL'.format(
+            self.encodeTableName(schema, gen_table), ','.join(columns), self.encodeTableName(schema, table),
+            self.encodeColumnName(column)))
+
+    def createTableAs(self, schema, table, sql):
+        """Creates a table from the results of a query. Returns the number of rows in the table."""
+        self.invalidateCatalog(schema, table)
+        cursor = self.c.cursor()
+        cursor.execute('CREATE TABLE {} AS {}'.format(self.encodeTableName(schema, table), sql))
+        rows = cursor.rowcount
+        self.commit()
+        cursor.close()
+        return rows
+
+    def distinctValues(self, schema, table, expressions):
+        """Returns the distinct non-null values of several text expressions on a table, as a list of
+           lists of values in the same order as the expressions. The table is only scanned once.
+        """
+        r = self.fetchSqlRecords('SELECT {} FROM {}'.format(
+            ','.join(['array_agg(DISTINCT {0}) FILTER (WHERE {0} IS NOT NULL)'.format(e) for e in expressions]),
+            self.encodeTableName(schema, table)))
+        return [values or [] for values in r[0]]
+
+    def enumValues(self, schema, name):
+        """Returns the values of an enum type in order, or None if the type does not exist"""
+        if not self.fetchSqlRecords("SELECT to_regtype('{}')".format(
+                self.encodeLiteral(self.encodeTableName(schema, name))))[0][0]:
+            return None
+        r = self.fetchSqlRecords(
+            "SELECT e.enumlabel FROM pg_enum e WHERE e.enumtypid = '{}'::regtype ORDER BY e.enumsortorder".format(
+                self.encodeLiteral(self.encodeTableName(schema, name))))
+        return [row[0] for row in r]
+
+    def updateEnumType(self, schema, name, values):
+        """Creates an enum type with the specified values, or adds any missing values to an existing type"""
+        type_name = self.encodeTableName(schema, name)
+        existing = self.enumValues(schema, name)
+        if existing is None:
+            # the lock stops concurrent imports from creating the same type
+            self.runSql("SELECT pg_advisory_xact_lock(hashtext('{0}'));"
+                        "DO $$ BEGIN IF to_regtype('{0}') IS NULL THEN CREATE TYPE {1} AS ENUM ({2}); END IF; END $$".format(
+                            self.encodeLiteral(type_name), type_name,
+                            ','.join(["'{}'".format(self.encodeLiteral(v)) for v in sorted(values)])))
+            existing = self.enumValues(schema, name)
+        for v in sorted(set(values) - set(existing)):
+            # values can't be added to an enum inside a transaction block before Postgres 12
+            self.runSqlNoTransaction("ALTER TYPE {} ADD VALUE IF NOT EXISTS '{}'".format(
+                type_name, self.encodeLiteral(v)))
+        return True
+
+    def columnProfiles(self, schema, table, expressions):
+        """Profiles the values of several expressions on a table in a single scan. Returns a dict for
+           each expression with the number of non-null values, the number of non-empty values, the
+           maximum text length, whether all values are whole numbers (integral), the largest absolute
+           whole number value, whether any value has leading zeros and whether all values are valid
+           dates according to vicmap.narrow_date.
+        """
+        integral = "'^-?[0-9]+(\\.0*)?$'"
+        aggregates = []
+        for e in expressions:
+            t = "NULLIF(({})::text, '')".format(e)
+            aggregates.extend(['count(({})::text)'.format(e),
+                               'count({})'.format(t),
+                               'max(length({}))'.format(t),
+                               'bool_and({} ~ {})'.format(t, integral),
+                               'max(abs(CASE WHEN {0} ~ {1} THEN {0}::numeric END))'.format(t, integral),
+                               "bool_or({} ~ '^-?0[0-9]')".format(t),
+                               'bool_and(vicmap.narrow_date({0}, false) IS NOT NULL) FILTER (WHERE {0} IS NOT NULL)'.format(t)])
+        r = self.fetchSqlRecords('SELECT count(*), {} FROM {}'.format(','.join(aggregates), self.encodeTableName(schema, table)))[0]
+
+        keys = ('values', 'non_empty', 'max_length', 'integral', 'max_abs', 'leading_zeros', 'dates')
+        return [dict([('rows', r[0])] + zip(keys, r[1 + i * len(keys):1 + (i + 1) * len(keys)]))
+                for i in range(len(expressions))]
+
+    def hasPrimaryKey(self, schema, table):
+        """Tests whether a table has a primary key constraint"""
+        r = self.fetchSqlRecords(
+            "select count(*) from pg_constraint where contype = 'p' and conrelid = '{}'::regclass".format(
+                self.encodeLiteral(self.encodeTableName(schema, table))))
+        return r[0][0] > 0
+
+    def tableStatistics(self, schema, table, geom_column=None, key_column=None):
+        """Calculates statistics for a table in a single scan. Returns a dict with the number of rows,
+           and if geom_column is set the number of null, empty and invalid geometries and the extent.
+           If key_column is set the number of duplicate key values is also returned.
+        """
+        stats = ['count(*)']
+        keys = ['rows']
+        if geom_column:
+            geom = self.encodeColumnName(geom_column)
+            stats.extend(['count(*) FILTER (WHERE {} IS NULL)'.format(geom),
+                          'count(*) FILTER (WHERE ST_IsEmpty({}))'.format(geom),
+                          'count(*) FILTER (WHERE NOT ST_IsValid({}))'.format(geom),
+                          'ST_Extent({})::text'.format(geom)])
+            keys.extend(['null_geometries', 'empty_geometries', 'invalid_geometries', 'extent'])
+        if key_column:
+            key = self.encodeColumnName(key_column)
+            stats.append('count({0}) - count(DISTINCT {0})'.format(key))
+            keys.append('duplicate_keys')
+        r = self.fetchSqlRecords('SELECT {} FROM {}'.format(','.join(stats), self.encodeTableName(schema, table)))
+        return dict(zip(keys, r[0]))
+
+    def makeValid(self, schema, table, column, geom_def):
+        """Repairs the invalid geometries in a table using ST_MakeValid, keeping only the parts which
+           match the column's geometry type. Returns the number of repaired geometries.
+        """
+        geom = self.encodeColumnName(column)
+        geometry_type = geom_def[geom_def.find('(') + 1:].split(',')[0].upper() if '(' in geom_def else 'GEOMETRY'
+        repaired = 'ST_MakeValid({})'.format(geom)
+        dimension = {'POINT': 1, 'LINESTRING': 2, 'POLYGON': 3}.get(geometry_type.replace('MULTI', ''))
+        if dimension:
+            repaired = 'ST_CollectionExtract({}, {})'.format(repaired, dimension)
+            if geometry_type.startswith('MULTI'):
+                repaired = 'ST_Multi({})'.format(repaired)
+
+        cursor = self.c.cursor()
+        # geometries which can't be repaired to the column's type are left as they are
+        # rows are matched by tableoid as well as ctid, since ctids are only unique within each partition
+        cursor.execute('UPDATE {0} SET {1} = r.geom FROM (SELECT tableoid, ctid, {2} AS geom FROM {0} WHERE NOT ST_IsValid({1})) r '
+                       'WHERE {0}.tableoid = r.tableoid AND {0}.ctid = r.ctid AND {3}'.format(
+                           self.encodeTableName(schema, table), geom, repaired,
+                           "GeometryType(r.geom) = '{}' AND NOT ST_IsEmpty(r.geom)".format(geometry_type) if dimension else 'true'))
+        rows = cursor.rowcount
+        self.commit()
+        cursor.close()
+        return rows
 
     def recordCount(self, schema, table):
         """ Returns the number of rows in a table """
@@ -142,11 +469,83 @@ class Database():
             "SELECT count(*) FROM {}".format(self.encodeTableName(schema, table)))
         return r[0][0]
 
-    def copyData(self, src_schema, src_table, src_columns, dest_schema, dest_table, dest_columns):
-        """Copies data from one table to another"""
+    def tableIsEmpty(self, schema, table):
+        """ Tests whether a table has no rows, without counting them """
+        r = self.fetchSqlRecords(
+            "SELECT NOT EXISTS (SELECT 1 FROM {})".format(self.encodeTableName(schema, table)))
+        return r[0][0]
+
+    def copyData(self, src_schema, src_table, src_columns, dest_schema, dest_table, dest_columns, order_by=None):
+        """Copies data from one table to another, optionally inserting the rows in the order of an expression.
+           Returns the number of rows copied.
+        """
         sql = 'INSERT INTO {} ( {} ) SELECT {} FROM {}'.format(self.encodeTableName(dest_schema, dest_table), ','.join(dest_columns),
                                                                ','.join(src_columns), self.encodeTableName(src_schema, src_table))
-        return self.runSql(sql)
+        if order_by:
+            sql += ' ORDER BY {}'.format(order_by)
+        cursor = self.c.cursor()
+        cursor.execute(sql)
+        rows = cursor.rowcount
+        self.commit()
+        cursor.close()
+        return rows
+
+    def applyDelta(self, src_schema, src_table, src_columns, dest_schema, dest_table, dest_columns, key):
+        """Updates a table to match the data selected from another table, only inserting, updating and
+           deleting the rows which differ. Rows are matched using the key column and compared using a hash of
+           their values. All changes are made in a single transaction.
+           Returns a dict of the number of inserted, updated and deleted rows, or None if the source
+           key values are not unique.
+        """
+        assert not self.transaction_depth, 'Deltas are applied in their own transaction'
+        delta_table = 'vicmap2pgsql_delta'
+        dest = self.encodeTableName(dest_schema, dest_table)
+        key = self.encodeColumnName(key)
+        cols = [self.encodeColumnName(c) for c in dest_columns]
+
+        def row(alias):
+            return 'md5(ROW({})::text)'.format(','.join(['{}.{}'.format(alias, c) for c in cols]))
+
+        cursor = self.c.cursor()
+        try:
+            cursor.execute('CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {} FROM {}'.format(
+                delta_table, ','.join(['{} AS {}'.format(s, c) for s, c in zip(src_columns, cols)]),
+                self.encodeTableName(src_schema, src_table)))
+            cursor.execute('SELECT count(*) = count({0}) AND count(*) = count(DISTINCT {0}) FROM {1}'.format(key, delta_table))
+            if not cursor.fetchone()[0]:
+                self.c.rollback()
+                return None
+            cursor.execute('CREATE INDEX ON {} ({}); ANALYZE {}'.format(delta_table, key, delta_table))
+
+            changes = {}
+            cursor.execute('DELETE FROM {0} d WHERE NOT EXISTS (SELECT 1 FROM {1} s WHERE s.{2} = d.{2})'.format(
+                dest, delta_table, key))
+            changes['deleted'] = cursor.rowcount
+            cursor.execute('UPDATE {0} d SET {1} FROM {2} s WHERE s.{3} = d.{3} AND {4} <> {5}'.format(
+                dest, ','.join(['{0} = s.{0}'.format(c) for c in cols]), delta_table, key, row('d'), row('s')))
+            changes['updated'] = cursor.rowcount
+            cursor.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2} s WHERE NOT EXISTS (SELECT 1 FROM {0} d WHERE d.{3} = s.{3})'.format(
+                dest, ','.join(cols), delta_table, key))
+            changes['inserted'] = cursor.rowcount
+            self.c.commit()
+            return changes
+        except:
+            self.c.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def copyFromStream(self, schema, table, columns, stream):
+        """Loads data into a table using COPY FROM STDIN. stream is a file-like object
+           returning rows in the Postgres text COPY format.
+        """
+        sql = 'COPY {} ( {} ) FROM STDIN'.format(self.encodeTableName(schema, table), ','.join(
+            [self.encodeColumnName(c) for c in columns]))
+        cursor = self.c.cursor()
+        cursor.copy_expert(sql, stream)
+        self.commit()
+        cursor.close()
+        return True
 
     def schemaExists(self, schema):
         """Tests whether the specified schema exists in the database"""
@@ -158,10 +557,91 @@ class Database():
         """Creates a schema"""
         return self.runSql('CREATE SCHEMA IF NOT EXISTS {}'.format(self.encodeSchemaName(schema)))
 
+    def dropSchema(self, schema, cascade=False):
+        """Drops a schema"""
+        self.invalidateCatalog(schema)
+        if cascade:
+            return self.runSql('DROP SCHEMA IF EXISTS {} CASCADE'.format(self.encodeSchemaName(schema)))
+        else:
+            return self.runSql('DROP SCHEMA IF EXISTS {}'.format(self.encodeSchemaName(schema)))
+
     def createSpatialIndex(self, schema, table, column):
         """Creates a spatial index on a geometry column"""
+        return self.createIndexes(schema, table, [self.spatialIndexDefinition(schema, table, column)])
+
+    def spatialIndexDefinition(self, schema, table, column):
+        """Returns the definition of a spatial index on a geometry column, for use with createIndexes"""
         index_name = '{}_{}_idx'.format(table, column)
-        return self.runSql('CREATE INDEX {} ON {} USING gist ({})'.format(index_name, self.encodeTableName(schema, table), self.encodeColumnName(column)))
+        return {'name': index_name,
+                'definition': 'CREATE INDEX {} ON {} USING gist ({})'.format(index_name, self.encodeTableName(schema, table), self.encodeColumnName(column)),
+                'constraint': False}
+
+    def primaryKeyDefinition(self, table, column):
+        """Returns the definition of a primary key constraint on a column or list of columns, for use with createIndexes"""
+        columns = column if isinstance(column, list) else [column]
+        return {'name': '{}_pkey'.format(table),
+                'definition': 'PRIMARY KEY ({})'.format(','.join([self.encodeColumnName(c) for c in columns])),
+                'constraint': True}
+
+    def getIndexDefinitions(self, schema, table):
+        """Returns the definitions of all indexes on a table, including those backing primary key
+           and unique constraints. The definitions can be used to recreate the indexes using createIndexes.
+        """
+        defs = self.fetchSqlRecords(
+            "select i.relname, pg_get_indexdef(i.oid), c.conname, pg_get_constraintdef(c.oid) from pg_index x "
+            "join pg_class i on i.oid = x.indexrelid "
+            "left join pg_constraint c on c.conindid = x.indexrelid and c.conrelid = x.indrelid "
+            "where x.indrelid = '{}'::regclass order by i.relname".format(self.encodeLiteral(self.encodeTableName(schema, table))))
+        return [{'name': d[2], 'definition': d[3], 'constraint': True} if d[2] else
+                {'name': d[0], 'definition': d[1], 'constraint': False} for d in defs]
+
+    def tableIsReferenced(self, schema, table):
+        """Tests whether any foreign key constraints reference a table"""
+        r = self.fetchSqlRecords(
+            "select count(*) from pg_constraint where contype = 'f' and confrelid = '{}'::regclass".format(
+                self.encodeLiteral(self.encodeTableName(schema, table))))
+        return r[0][0] > 0
+
+    def dropIndexes(self, schema, table, indexes):
+        """Drops indexes and constraints previously retrieved using getIndexDefinitions"""
+        sql = []
+        for i in indexes:
+            if i['constraint']:
+                sql.append('ALTER TABLE {} DROP CONSTRAINT {}'.format(
+                    self.encodeTableName(schema, table), self.encodeColumnName(i['name'])))
+            else:
+                sql.append('DROP INDEX {}'.format(self.encodeTableName(schema, i['name'])))
+        return self.runSqlBatch(sql)
+
+    def createIndexes(self, schema, table, indexes, maintenance_work_mem=None):
+        """Creates indexes and constraints from a list of definitions, in a single transaction.
+           param maintenance_work_mem optionally raises the memory available for building the indexes, eg '1GB'
+        """
+        sql = []
+        if maintenance_work_mem:
+            sql.append("SET LOCAL maintenance_work_mem = '{}'".format(self.encodeLiteral(maintenance_work_mem)))
+        for i in indexes:
+            if i['constraint']:
+                sql.append('ALTER TABLE {} ADD CONSTRAINT {} {}'.format(
+                    self.encodeTableName(schema, table), self.encodeColumnName(i['name']), i['definition']))
+            else:
+                sql.append(i['definition'])
+        return self.runSqlBatch(sql)
+
+    def clusterTable(self, schema, table, column):
+        """Physically reorders a table using the spatial index on a geometry column.
+           Returns False if the column has no spatial index.
+        """
+        r = self.fetchSqlRecords(
+            "select i.relname from pg_index x "
+            "join pg_class i on i.oid = x.indexrelid "
+            "join pg_am a on a.oid = i.relam "
+            "join pg_attribute att on att.attrelid = x.indrelid and att.attnum = x.indkey[0] "
+            "where x.indrelid = '{}'::regclass and a.amname = 'gist' and att.attname = '{}'".format(
+                self.encodeLiteral(self.encodeTableName(schema, table)), self.encodeLiteral(column)))
+        if not r:
+            return False
+        return self.runSql('CLUSTER {} USING "{}"'.format(self.encodeTableName(schema, table), r[0][0]))
 
     def vacuum(self, schema, table):
         """Vacuums a table"""
@@ -0,0 +1,257 @@
+#!python
+
+from database import Database
+from osgeo import ogr, osr
+import binascii
+import struct
+
+
+class RowStream():
+    """ File-like object which returns rows from an iterator, for use with COPY FROM STDIN """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.rows)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class DirectLoader():
+    """ Streams a shapefile or DBF straight into its destination table using the OGR python
+    bindings and COPY FROM STDIN, avoiding the temporary import table in the public schema
+    """
+
+    # Number of features to read before evaluating column transforms for the new values
+    BATCH_SIZE = 10000
+
+    # Postgres types used for source values when evaluating column transforms
+    FIELD_TYPES = {ogr.OFTInteger: 'integer',
+                   ogr.OFTInteger64: 'bigint',
+                   ogr.OFTReal: 'double precision',
+                   ogr.OFTDate: 'date'}
+
+    GEOMETRY_TYPES = {ogr.wkbPoint: 'Point',
+                      ogr.wkbLineString: 'LineString',
+                      ogr.wkbPolygon: 'Polygon',
+                      ogr.wkbMultiPoint: 'MultiPoint',
+                      ogr.wkbMultiLineString: 'MultiLineString',
+                      ogr.wkbMultiPolygon: 'MultiPolygon'}
+
+    MULTI_TYPES = {ogr.wkbPoint: ogr.wkbMultiPoint,
+                   ogr.wkbLineString: ogr.wkbMultiLineString,
+                   ogr.wkbPolygon: ogr.wkbMultiPolygon}
+
+    # Source and destination CRS, matching the ogr2ogr import (GDA94 to Vicgrid)
+    SOURCE_SRID = 4283
+    DEST_SRID = 3111
+
+    def __init__(self, importer, path, schema, table, dest_schema, dest_table):
+        self.importer = importer
+        self.db = importer.db
+        self.path = path
+        self.schema = schema
+        self.table = table
+        self.dest_schema = dest_schema
+        self.dest_table = dest_table
+        self.is_shapefile = path[-3:].lower() == 'shp'
+
+        self.data_source = ogr.Open(path)
+        self.layer = self.data_source.GetLayer(0) if self.data_source else None
+
+        self.geometry_type = None
+        if self.layer and self.is_shapefile:
+            self.geometry_type = ogr.GT_Flatten(self.layer.GetGeomType())
+            if self.importer.isMulti(schema, table) and self.geometry_type in self.MULTI_TYPES:
+                self.geometry_type = self.MULTI_TYPES[self.geometry_type]
+
+    def fields(self):
+        """ Returns a list of (index, lower case name, OGR field type) for the source fields """
+        defn = self.layer.GetLayerDefn()
+        return [(i, defn.GetFieldDefn(i).GetName().lower(), defn.GetFieldDefn(i).GetType())
+                for i in range(defn.GetFieldCount())]
+
+    def sourceColumns(self):
+        """ Returns the source column names, as they would be named by an ogr2ogr import """
+        columns = [name for i, name, field_type in self.fields()]
+        if self.is_shapefile:
+            columns.insert(0, 'geom')
+        return columns
+
+    def geometryColumnDefinition(self):
+        """ Returns the definition for the layer's geometry column """
+        if not self.is_shapefile:
+            return None
+        return 'geometry({},{})'.format(self.GEOMETRY_TYPES[self.geometry_type], self.DEST_SRID)
+
+    def transformSql(self, transform, column, field_type, values):
+        """ Returns SQL evaluating a column transform for a list of source values """
+        array = 'ARRAY[{}]::text[]'.format(','.join(
+            ["'{}'".format(self.db.encodeLiteral(v)) if v is not None else 'NULL' for v in values]))
+        return 'SELECT ({})::text FROM unnest({}::{}[]) WITH ORDINALITY AS src("{}", ord) ORDER BY ord'.format(
+            transform, array, self.FIELD_TYPES.get(field_type, 'text'), column)
+
+    def unsupportedReason(self):
+        """ Returns the reason why the layer can't be loaded directly, or None if it can """
+        if not self.layer:
+            return 'could not open source'
+        if self.is_shapefile and self.geometry_type not in self.GEOMETRY_TYPES:
+            return 'unsupported geometry type'
+        if self.is_shapefile and ogr.GT_HasZ(self.layer.GetGeomType()):
+            return '3D geometries'
+        if self.is_shapefile and self.importer.coordinatePrecision(self.schema, self.table):
+            # coordinates are snapped while copying from the temporary import table
+            return 'coordinate precision'
+        if self.importer.narrow_types and (self.importer.recreate or self.importer.swap or
+                                           not self.db.tableExists(self.dest_schema, self.dest_table)):
+            # column types are narrowed by profiling the temporary import table
+            return 'narrowing column types'
+        for i, name, field_type in self.fields():
+            matched_map = self.importer.getMappedColumnDef(
+                self.dest_schema, self.dest_table, name)
+            if matched_map and matched_map.get('dictionary'):
+                # the enum values are collected from the temporary import table
+                return 'dictionary encoded column {}'.format(name)
+            if matched_map and 'transform' in matched_map.keys():
+                # transforms are evaluated one source column at a time
+                if not self.db.sqlIsValid(self.transformSql(matched_map['transform'], name, field_type, [])):
+                    return 'transform for {} uses other columns'.format(name)
+        return None
+
+    def encodeCopyValue(self, value):
+        """ Encodes a value for the COPY text format """
+        if value is None:
+            return '\\N'
+        value = value.decode('utf-8', 'replace').encode('utf-8')
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def encodeGeometry(self, geom):
+        """ Encodes a geometry as hex EWKB, including the destination SRID """
+        wkb = geom.ExportToWkb(ogr.wkbNDR)
+        geom_type = struct.unpack('<I', wkb[1:5])[0] | 0x20000000
+        return binascii.hexlify(wkb[0] + struct.pack('<II', geom_type, self.DEST_SRID) + wkb[5:])
+
+    def coordinateTransform(self):
+        """ Returns the transform from GDA94 to Vicgrid """
+        source = osr.SpatialReference()
+        source.ImportFromEPSG(self.SOURCE_SRID)
+        dest = osr.SpatialReference()
+        dest.ImportFromEPSG(self.DEST_SRID)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            # shapefile coordinates are always longitude, latitude
+            source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            dest.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        return osr.CoordinateTransformation(source, dest)
+
+    def load(self, load_table=None):
+        """ Streams the layer into the destination table, or into load_table in the destination
+        schema if set. Returns the number of rows loaded.
+        """
+        if not load_table:
+            load_table = self.dest_table
+        dest_types = dict([(c['name'], c['type'])
+                           for c in self.db.getTableColumnDefs(self.dest_schema, load_table)])
+
+        # work out which source fields map to which destination columns
+        columns = []
+        dest_cols = []
+        for i, name, field_type in self.fields():
+            matched_map = self.importer.getMappedColumnDef(
+                self.dest_schema, self.dest_table, name)
+            if not matched_map:
+                # discard column
+                continue
+            if matched_map['column_name'] not in dest_types:
+                # column not in destination table, ignore
+                continue
+
+            transform = matched_map.get('transform')
+            round_values = field_type == ogr.OFTReal and dest_types[matched_map['column_name']] in (
+                'smallint', 'integer', 'bigint')
+            columns.append((i, name, field_type, transform, round_values))
+            dest_cols.append(matched_map['column_name'])
+
+        if self.is_shapefile:
+            dest_cols.append('geom')
+
+        self.rows_loaded = 0
+        print 'Streaming data to destination table'
+        self.db.copyFromStream(self.dest_schema, load_table, dest_cols,
+                               RowStream(self.rows(columns)))
+        if self.skipped:
+            print 'Skipped {} features with mismatched geometry types'.format(self.skipped)
+        return self.rows_loaded
+
+    def rows(self, columns):
+        """ Generates COPY rows for all features in the layer """
+        transform_cache = dict([(name, {}) for i, name, field_type, transform, round_values
+                                in columns if transform])
+        # transforms are evaluated on a separate connection, as the loader's connection is busy with the COPY
+        transform_db = Database() if transform_cache else None
+        self.skipped = 0
+        self.layer.ResetReading()
+
+        coordinate_transform = self.coordinateTransform() if self.is_shapefile else None
+        force_multi = self.geometry_type in self.MULTI_TYPES.values()
+
+        while True:
+            batch = []
+            for f in iter(self.layer.GetNextFeature, None):
+                values = []
+                for i, name, field_type, transform, round_values in columns:
+                    if not f.IsFieldSet(i) or (hasattr(f, 'IsFieldNull') and f.IsFieldNull(i)):
+                        values.append(None)
+                    elif round_values:
+                        values.append(str(int(round(f.GetFieldAsDouble(i)))))
+                    else:
+                        values.append(f.GetFieldAsString(i))
+
+                if coordinate_transform:
+                    geom = f.GetGeometryRef()
+                    if geom is None:
+                        values.append('\\N')
+                    else:
+                        geom = geom.Clone()
+                        geom.Transform(coordinate_transform)
+                        if force_multi:
+                            geom = ogr.ForceTo(geom, self.geometry_type)
+                        if ogr.GT_Flatten(geom.GetGeometryType()) != self.geometry_type:
+                            # matches ogr2ogr -skipfailures behaviour
+                            self.skipped += 1
+                            continue
+                        values.append(self.encodeGeometry(geom))
+
+                batch.append(values)
+                if len(batch) >= self.BATCH_SIZE:
+                    break
+
+            if not batch:
+                if transform_db:
+                    transform_db.closeConnection()
+                return
+
+            # evaluate transforms for any values not seen before
+            for idx, (i, name, field_type, transform, round_values) in enumerate(columns):
+                if not transform:
+                    continue
+                cache = transform_cache[name]
+                new_values = list(set([r[idx] for r in batch if r[idx] not in cache]))
+                if new_values:
+                    results = transform_db.fetchSqlRecords(
+                        self.transformSql(transform, name, field_type, new_values))
+                    cache.update(zip(new_values, [r[0] for r in results]))
+                for r in batch:
+                    r[idx] = cache[r[idx]]
+
+            for r in batch:
+                self.rows_loaded += 1
+                yield '\t'.join([r[idx] if idx >= len(columns) else self.encodeCopyValue(r[idx])
+                                 for idx in range(len(r))]) + '\n'
@@ -2,7 +2,10 @@
 
 from database import Database
 from importer import Importer
+from scheduler import Scheduler
+import source
 import os
+import sys
 import argparse
 import glob
 
@@ -20,6 +23,40 @@ if __name__ == "__main__":
                         help='Forces dropping any existing tables and recreating. Be careful!')
     parser.add_argument('--skipshpimport', action='store_true', default=False,
                         help='Skips the initial shp file import to a temporary table in the public schema. For debugging only.')
+    parser.add_argument('--direct', action='store_true', default=False,
+                        help='Streams layers straight into the destination tables using the GDAL/OGR python bindings, skipping the temporary import table.')
+    parser.add_argument('--defer-indexes', action='store_true', default=False,
+                        help='Creates primary keys and spatial indexes after loading tables, instead of maintaining them during the load.')
+    parser.add_argument('--maintenance-work-mem',
+                        help='Memory to use when building deferred indexes, eg 1GB.')
+    parser.add_argument('--swap', action='store_true', default=False,
+                        help='Loads existing tables into a shadow table which is swapped into place once complete, instead of truncating them.')
+    parser.add_argument('--delta', action='store_true', default=False,
+                        help='Updates existing tables with a ufi column by only inserting, updating and deleting changed rows.')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Imports all layers, even if they are unchanged since they were last imported.')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='Resumes an interrupted run, skipping the layers it completed and reusing intact temporary import tables.')
+    parser.add_argument('--narrow-types', choices=['propose', 'apply'],
+                        help='Profiles the imported data when creating tables, and proposes or applies narrower column types (eg integer instead of numeric).')
+    parser.add_argument('--validate', action='store_true', default=False,
+                        help='Validates each destination table in a single scan, recording row, null, empty and invalid geometry and duplicate key counts and the extent in vicmap.import_statistics.')
+    parser.add_argument('--make-valid', action='store_true', default=False,
+                        help='Repairs invalid geometries found by --validate using ST_MakeValid.')
+    parser.add_argument('--precision', type=float,
+                        help='Snaps geometry coordinates to a grid of this size in metres, eg 0.01, unless set by the precision table mapping option.')
+    parser.add_argument('--mapping-cache',
+                        help='Directory for caching the compiled table and column mappings.')
+    parser.add_argument('--metrics-file',
+                        help='Appends the timings and throughput for each import phase to this file as JSON lines, instead of printing them.')
+    parser.add_argument('--profile',
+                        help='Directory to write cProfile output for each layer to.')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of layers to import concurrently, each in a separate worker process with its own database connection.')
+    parser.add_argument('--chunks', type=int, default=1,
+                        help='Splits large layers into this many ranges of features, which are staged by concurrent ogr2ogr processes.')
+    parser.add_argument('--pipeline', type=int, default=0,
+                        help='Stages up to this many layers on a separate connection while the previous layer is loaded.')
     args = parser.parse_args()
 
     folder = args.folder  # .lower()
@@ -29,6 +66,7 @@ if __name__ == "__main__":
         dataset = None
     recreate = args.recreate
     skip_shape_import = args.skipshpimport
+    jobs = args.jobs
     print "Importing from {}".format(folder.upper())
     if dataset:
         print "  Dataset: {}".format(dataset.upper())
@@ -36,7 +74,12 @@ if __name__ == "__main__":
         print "  Existing table definitions will be removed!"
 
     layers = []
-    if dataset:
+    if os.path.isfile(folder) and folder.lower().endswith('.zip'):
+        # read the layers straight from a downloaded zip file
+        for l in source.zipLayers(folder):
+            if not args.dataset or Scheduler.layerName(l).lower() == args.dataset.lower():
+                layers.append(l)
+    elif dataset:
         dataset = os.path.basename(os.path.normpath(folder)).lower()
         shape_file = os.path.join(folder, 'layer', '{}.shp'.format(dataset))
         if os.path.isfile(shape_file):
@@ -52,26 +95,42 @@ if __name__ == "__main__":
         for s in glob.glob(os.path.join(folder, 'table', '*.dbf')):
             layers.append({'dataset': dataset, 'layer': s})
 
-    if len(layers) == 0:
+    if len(layers) == 0 and os.path.isdir(folder):
         for d in [name for name in os.listdir(folder)
                   if os.path.isdir(os.path.join(folder, name))]:
             for s in glob.glob(os.path.join(folder, d, 'layer', '*.shp')):
                 layers.append({'dataset': d.lower(), 'layer': s})
             for s in glob.glob(os.path.join(folder, d, 'table', '*.dbf')):
                 layers.append({'dataset': d.lower(), 'layer': s})
+        for z in sorted(glob.glob(os.path.join(folder, '*.zip'))):
+            layers.extend(source.zipLayers(z))
 
     print "\nLayers to be processed are:"
     for l in layers:
         print '{}: {}'.format(l['dataset'], l['layer'])
 
-    i = Importer(Database())
+    i = Importer(Database(), args.mapping_cache)
     i.recreate = recreate
     i.skip_shape_import = skip_shape_import
+    i.direct = args.direct
+    i.defer_indexes = args.defer_indexes
+    i.maintenance_work_mem = args.maintenance_work_mem
+    i.swap = args.swap
+    i.force = args.force or recreate
+    i.delta = args.delta
+    i.metrics_file = args.metrics_file
+    i.profile_dir = args.profile
+    i.chunks = args.chunks
+    i.resume = args.resume
+    i.narrow_types = args.narrow_types
+    i.validate = args.validate or args.make_valid
+    i.make_valid = args.make_valid
+    i.precision = args.precision
     i.setupDatabase()
 
-    for idx, l in enumerate(layers):
-        print "\n\nImporting {}/{}: {}\n-------------".format(idx + 1, len(layers), l['layer'])
-        path, file = os.path.split(l['layer'])
-        layer = file[:-4]
-
-        i.importLayer(l['layer'], l['dataset'], layer)
+    failures = Scheduler(i, jobs, args.pipeline).run(layers)
+    if failures:
+        print "\n{} layers failed to import:".format(len(failures))
+        for l, error in failures:
+            print '{}: {}'.format(l['dataset'], l['layer'])
+        sys.exit(1)
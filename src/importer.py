@@ -1,116 +1,933 @@
 #!python
 
+from journal import Journal
+from manifest import Manifest
+from metrics import Metrics
+from tablestatistics import TableStatistics
+import source
 import subprocess
+import cPickle as pickle
+import hashlib
 import json
+import glob
 import os
 
 
 class Importer():
     """ Handles importing the source tables into the database destination """
 
-    def __init__(self, db):
+    # Options which are copied across to the importers used by worker processes
+    SETTINGS = ('recreate', 'skip_shape_import', 'temp_schema', 'direct', 'defer_indexes',
+                'maintenance_work_mem', 'swap', 'force', 'delta', 'mapping_cache', 'metrics_file',
+                'profile_dir', 'chunks', 'resume', 'narrow_types', 'validate', 'make_valid',
+                'precision')
+
+    # Column used to match rows when applying deltas
+    DELTA_KEY = 'ufi'
+
+    # Expressions for ordering the rows of the temporary import table by a spatial key, for the
+    # spatial_order table mapping option. Geometries sort along a Hilbert curve in PostGIS 3+.
+    SPATIAL_ORDER_KEYS = {'hilbert': 'geom',
+                          'geohash': 'ST_GeoHash(ST_Transform(ST_Centroid(ST_Envelope(geom)), 4283))'}
+
+    # Schema for the enum types of dictionary encoded columns
+    DICTIONARY_SCHEMA = 'vicmap'
+
+    # Mapped data types which can be narrowed to integers or dates, see narrowColumnTypes()
+    NUMERIC_TYPES = ('numeric', 'real', 'double precision')
+    TEXT_TYPES = ('text', 'character varying')
+
+    # Types which columns can be narrowed to, and the mapped data types they are equivalent to
+    NARROWED_TYPES = {'integer': ('integer', 'int'),
+                      'bigint': ('bigint',),
+                      'date': ('date',)}
+
+    # Column holding the source layer of each row in partitioned destination tables, which are
+    # list partitioned on it
+    PARTITION_COLUMN = 'source_layer'
+
+    # Dataset name used to record join tables in the import manifest
+    JOIN_DATASET = 'join'
+
+    # Minimum number of features in each chunk when a layer is split across several ogr2ogr processes
+    CHUNK_MIN_FEATURES = 100000
+
+    # Version of the compiled mappings cached by loadMappings(). Must be increased whenever
+    # compileMappings() changes the shape of the compiled mappings, so stale caches aren't loaded.
+    MAPPINGS_FORMAT = 1
+
+    def __init__(self, db, mapping_cache=None):
+        """ mapping_cache is an optional directory for caching the compiled table and column mappings """
         self.db = db
         self.recreate = False
         self.skip_shape_import = False
+        self.temp_schema = 'public'
+        self.direct = False
+        self.defer_indexes = False
+        self.maintenance_work_mem = None
+        self.swap = False
+        self.force = False
+        self.delta = False
+        self.metrics_file = None
+        self.profile_dir = None
+        self.chunks = 1
+        self.resume = False
+        self.narrow_types = None
+        self.validate = False
+        self.make_valid = False
+        self.precision = None
+
+        self.mapping_cache = mapping_cache
 
         self.base_dir = os.path.dirname(os.path.realpath(__file__))
+        self.loadMappings()
+        # table mappings which join destination tables, see buildJoin()
+        self.joinMappings = [m for m in self.tableMappings if 'join' in m.keys()]
+
+        self.manifest = Manifest(db)
+        self.journal = Journal(db)
+        self.statistics = TableStatistics(db)
+        self.metrics = Metrics()
 
+    def loadMappings(self):
+        """ Loads the table and column mappings, and compiles them into indexes for fast lookups.
+        If a mapping cache directory is set, the compiled mappings are cached there, keyed by a hash
+        of the mapping files and the format of the compiled mappings.
+        """
         with open(os.path.join(self.base_dir, '..', 'datasets', 'column_mappings.json')) as mappings:
-            self.columnMappings = json.load(mappings)
+            column_json = mappings.read()
 
         with open(os.path.join(self.base_dir, '..', 'datasets', 'table_mappings.json')) as mappings:
-            self.tableMappings = json.load(mappings)
+            table_json = mappings.read()
+
+        cache_file = None
+        if self.mapping_cache:
+            cache_file = os.path.join(self.mapping_cache, 'mappings_{}.pickle'.format(
+                hashlib.sha1('{}\n{}{}'.format(self.MAPPINGS_FORMAT, column_json, table_json)).hexdigest()))
+            if os.path.isfile(cache_file):
+                with open(cache_file, 'rb') as f:
+                    self.columnMappings, self.tableMappings, self.columnMappingIndex, self.tableMappingIndex = pickle.load(f)
+                return
+
+        self.columnMappings = json.loads(column_json)
+        self.tableMappings = json.loads(table_json)
+        self.compileMappings()
+
+        if cache_file:
+            if not os.path.isdir(self.mapping_cache):
+                os.makedirs(self.mapping_cache)
+            with open(cache_file, 'wb') as f:
+                pickle.dump((self.columnMappings, self.tableMappings, self.columnMappingIndex, self.tableMappingIndex),
+                            f, pickle.HIGHEST_PROTOCOL)
+
+    def compileMappings(self):
+        """ Builds the indexes used to look up table and column mappings.
+        tableMappingIndex maps (DATASET, TABLE) to the list of matching table mappings.
+        columnMappingIndex maps COLUMN_NAME_10 to a dict containing the 'default' column mapping
+        and a dict of 'tables' containing the mappings which override the default for specific tables.
+        Ambiguous mappings are stored as None.
+        """
+        self.tableMappingIndex = {}
+        for m in self.tableMappings:
+            if 'join' in m.keys():
+                continue
+            self.tableMappingIndex.setdefault(
+                (m['dataset'].upper(), m['table'].upper()), []).append(m)
+
+        matched_maps = {}
+        for m in self.columnMappings:
+            matched_maps.setdefault(m['column_name_10'].upper(), []).append(m)
+
+        self.columnMappingIndex = {}
+        for column_name, matched_map in matched_maps.items():
+            no_table_overrides = [m for m in matched_map if 'table_names' not in m.keys()]
+            table_overrides = {}
+            for m in matched_map:
+                if 'table_names' in m.keys():
+                    for table in m['table_names']:
+                        table_overrides.setdefault(table, []).append(m)
+
+            self.columnMappingIndex[column_name] = {
+                'default': no_table_overrides[0] if len(no_table_overrides) == 1 else None,
+                # Multiple matches for a table are ambiguous
+                'tables': dict([(t, m[0] if len(m) == 1 else None) for t, m in table_overrides.items()])}
+
+    def tableMapping(self, schema, table):
+        """ Returns the table mapping for a given input table, or None if there is no single matching mapping """
+        matched_map = self.tableMappingIndex.get((schema.upper(), table.upper()), [])
+        if not len(matched_map) == 1:
+            return None
+        return matched_map[0]
+
+    def settings(self):
+        """ Returns the import options as a dict, eg for passing to another Importer """
+        return dict((s, getattr(self, s)) for s in self.SETTINGS)
+
+    def applySettings(self, settings):
+        """ Applies import options previously retrieved using settings() """
+        for s, value in settings.items():
+            setattr(self, s, value)
 
     def setupDatabase(self):
         """ Sets up a database before starting the import, eg creating types, custom functions, etc """
 
-        with open(os.path.join(self.base_dir, '..', 'sql', 'postgis', '01_create_datatypes.sql'), 'r') as f:
-            sql = f.read()
+        for script in sorted(glob.glob(os.path.join(self.base_dir, '..', 'sql', 'postgis', '*.sql'))):
+            with open(script, 'r') as f:
+                sql = f.read()
+
+            self.db.runSqlNoTransaction(sql)
+
+    def importLayer(self, path, schema, table, staged=None, fingerprint=None):
+        """ Imports the specified layer. Returns the metrics recorded for the import. staged is
+        the staging phase returned by stageLayer() if the layer has already been staged, and
+        fingerprint is the layer's fingerprint if it has already been calculated.
+        """
+
+        self.metrics.startLayer(schema, table, path)
+        if staged:
+            self.metrics.addPhase(staged)
+        try:
+            count = self.importLayerPhases(path, schema, table, staged is not None, fingerprint)
+        except:
+            self.metrics.finishLayer('failed', output=self.metrics_file)
+            raise
+        return self.metrics.finishLayer('imported', count, self.metrics_file)
 
-        self.db.runSqlNoTransaction(sql)
+    def stageLayer(self, path, schema, table, fingerprint=None):
+        """ Imports a layer to its temporary import table ahead of loading it, eg on a separate
+        connection while another layer is being loaded. Returns the staging phase metrics, or None
+        if the layer isn't loaded from a temporary import table.
+        """
+        if not self.stagingRequired(path, schema, table):
+            return None
+        with self.metrics.phase('staging') as p:
+            rows = self.stageLayerUsingOGR(path, schema, table, fingerprint)
+            if rows is not None:
+                p['rows'] = rows
+        return p
 
-    def importLayer(self, path, schema, table):
-        """ Imports the specified layer """
+    def stageLayerUsingOGR(self, path, schema, table, fingerprint=None):
+        """ Imports a layer to its temporary import table, unless resuming an interrupted run which
+        left an intact temporary import table for the layer. The staged table is recorded in the journal,
+        with the layer's fingerprint if already calculated. Returns the number of source features, or
+        None if the table was reused.
+        """
+        if self.resume and self.resumeStaging(path, schema, table):
+            return None
+        if fingerprint is None:
+            fingerprint = self.currentFingerprint(path, schema, table)
+        self.importLayerUsingOGR(path, self.temp_schema, schema, table)
+        self.journal.record(schema, table, Journal.STAGED, self.temp_schema, fingerprint)
+        record_count, fields = source.dbfHeader(source.sidecarFile(path, 'dbf'))
+        return record_count
 
-        if not self.skip_shape_import:
-            self.importLayerUsingOGR(path, 'public', schema, table)
+    def resumeStaging(self, path, schema, table):
+        """ Reuses the temporary import table left by an interrupted run, if the source files and
+        mappings are unchanged since it was staged. Returns True if the table was reused.
+        """
+        entry = self.journal.entry(schema, table)
+        if not entry or entry['phase'] != Journal.STAGED:
+            return False
+        if not self.db.tableExists(entry['staging_schema'], table):
+            return False
+        if self.db.tableIsEmpty(entry['staging_schema'], table):
+            # temporary import tables are unlogged, so are emptied if the server crashes
+            print 'Temporary import table is empty, staging again'
+            return False
+        if self.layerFingerprint(path, schema, table, entry['fingerprint']) != entry['fingerprint']:
+            print 'Layer has changed since it was staged, staging again'
+            return False
+
+        if entry['staging_schema'] != self.temp_schema:
+            # eg staged by a different worker process
+            self.db.dropTable(self.temp_schema, table)
+            self.db.moveTable(entry['staging_schema'], table, self.temp_schema)
+            self.journal.record(schema, table, Journal.STAGED, self.temp_schema, entry['fingerprint'])
+        print 'Resuming from temporary import table {}.{}'.format(self.temp_schema, table)
+        return True
+
+    def stagingRequired(self, path, schema, table):
+        """ Returns True if a layer will be loaded from a temporary import table """
+        if self.skip_shape_import:
+            return False
+        if not self.direct:
+            return True
+        dest_schema, dest_table = self.destTable(schema, table)
+        if self.deltaApplies(dest_schema, dest_table,
+                             self.shouldAppendTable(schema, table) or self.partitionedTable(schema, table)):
+            return True
+        return self.directLoader(path, schema, table, dest_schema, dest_table) is None
+
+    def deltaApplies(self, dest_schema, dest_table, append):
+        """ Returns True if a layer should be applied to its destination table as a delta """
+        # deltas can only be applied to existing, non appended tables with a ufi column
+        return self.delta and not self.recreate and not append and self.db.tableHasColumn(
+            dest_schema, dest_table, self.DELTA_KEY)
+
+    def importLayerPhases(self, path, schema, table, staged=False, fingerprint=None):
+        """ Runs each phase of importing the specified layer. fingerprint is the layer's fingerprint,
+        if it has already been calculated. Returns the number of records in the destination table.
+        """
 
         dest_schema, dest_table = self.destTable(schema, table)
+        append = self.shouldAppendTable(schema, table)
+        partitioned = self.partitionedTable(schema, table)
+        delta = self.deltaApplies(dest_schema, dest_table, append or partitioned)
+
+        loader = None
+        if self.direct and not delta and not staged:
+            loader = self.directLoader(path, schema, table, dest_schema, dest_table)
+
+        if staged:
+            # the temporary import table was created on another connection
+            self.db.invalidateCatalog(self.temp_schema, table)
+            # and the layer was fingerprinted when it was staged
+            fingerprint = self.journal.entry(schema, table)['fingerprint']
+        else:
+            if fingerprint is None:
+                fingerprint = self.currentFingerprint(path, schema, table)
+            if not loader and not self.skip_shape_import:
+                with self.metrics.phase('staging') as p:
+                    rows = self.stageLayerUsingOGR(path, schema, table, fingerprint)
+                    if rows is not None:
+                        p['rows'] = rows
 
         if not self.db.schemaExists(dest_schema):
             print "Existing schema {} does not exist".format(dest_schema)
             self.db.createSchema(dest_schema)
 
-        if self.recreate:
-            # Possibly should drop cascaded, but that's dangerous...
+        if self.recreate and partitioned and self.db.tableExists(dest_schema, dest_table) and \
+                not self.db.tableIsPartitioned(dest_schema, dest_table):
+            # replaced by a partitioned table. Otherwise tables are dropped by the load, so a
+            # failed load leaves them in place.
             self.db.dropTable(dest_schema, dest_table)
 
-        append = self.shouldAppendTable(schema, table)
-        if not self.db.tableExists(dest_schema, dest_table):
-            print "Existing destination table {}.{} does not exist".format(dest_schema, dest_table)
-            if self.createTableDefinition('public', table, dest_schema, dest_table):
-                print "Created!"
+        if not loader:
+            self.encodeDictionaryColumns(table, dest_schema, dest_table)
+
+        precision = self.coordinatePrecision(schema, table)
+        loaded = None
+        if partitioned:
+            loaded = self.loadPartition(loader, table, dest_schema, dest_table,
+                                        self.spatialOrder(schema, table), precision)
+        elif not (delta and self.applyDelta(table, dest_schema, dest_table, precision)):
+            on_loaded = None
+            if append:
+                # appended rows can't be loaded again by a resumed run, so the layer is recorded as
+                # done in the same transaction as its rows, rather than once the import has finished
+                on_loaded = lambda: self.journal.record(schema, table, Journal.DONE, fingerprint=fingerprint)
+            loaded = self.loadTable(loader, table, dest_schema, dest_table, append,
+                                    self.spatialOrder(schema, table), precision, on_loaded)
+
+        if self.validate:
+            # only the layer's own partition of a partitioned table, since other layers' partitions
+            # may be being loaded by other processes
+            validate_table = self.partitionTable(dest_table, table) if partitioned else dest_table
+            with self.metrics.phase('validate') as p:
+                count = self.validateTable(schema, table, dest_schema, validate_table, p)
+        elif loaded is not None:
+            # the destination table only contains the loaded rows, so there's no need to count them
+            count = loaded
         else:
-            if not append:
-                self.db.truncateTable(dest_schema, dest_table)
+            with self.metrics.phase('count'):
+                count = self.db.recordCount(dest_schema, dest_table)
+        print 'Copied {} records to destination table'.format(count)
+        assert count > 0, 'No records exist in destination table!'
+
+        if not partitioned:
+            # partitioned tables are generalized once all their layers are loaded, see generalizePartitionedTable()
+            self.generalizeTable(schema, table, dest_schema, dest_table)
+
+        if not loader:
+            # Drop temporary table
+            with self.metrics.phase('drop_staging'):
+                self.db.dropTable(self.temp_schema, table)
+
+        self.manifest.record(schema, table, dest_schema, dest_table, fingerprint)
+        self.journal.record(schema, table, Journal.DONE, fingerprint=fingerprint)
+
+        return count
+
+    def loadTable(self, loader, table, dest_schema, dest_table, append, spatial_order=None, precision=None,
+                  on_loaded=None):
+        """ Loads a layer into its destination table, either from the temporary import table or
+        using a DirectLoader. The table is created if it doesn't exist, and otherwise truncated,
+        appended to or replaced by a shadow table. spatial_order is the spatial_order table mapping
+        option, if set, and precision is the grid size to snap coordinates to. on_loaded is an optional
+        function called in the load transaction once the rows are loaded. Returns the number
+        of rows in the destination table, or None if rows were appended to an existing table.
+        """
+        # table which the data is loaded into, either the destination table or its shadow table
+        load_table = dest_table
+        created = False
+        deferred_indexes = []
+
+        # the table is dropped, created or truncated, loaded and indexed in a single transaction,
+        # so a failed load is rolled back and leaves the table as it was
+        with self.db.transaction():
+            if self.recreate:
+                # Possibly should drop cascaded, but that's dangerous...
+                self.db.dropTable(dest_schema, dest_table)
+            exists = self.db.tableExists(dest_schema, dest_table)
+            swap = self.swap and exists and not append
+            if swap:
+                # the live table is dropped by the swap, which would fail after the whole load
+                dependents = self.db.getDependentObjects(dest_schema, dest_table)
+                if dependents:
+                    print 'Cannot swap {}.{}, it is used by {}. Truncating it instead'.format(
+                        dest_schema, dest_table, ', '.join(dependents))
+                    swap = False
+
+            if not exists or swap:
+                if swap:
+                    load_table = self.shadowTable(dest_table)
+                    print "Loading into shadow table {}.{}".format(dest_schema, load_table)
+                    self.db.dropTable(dest_schema, load_table)
+                else:
+                    print "Existing destination table {}.{} does not exist".format(dest_schema, dest_table)
+
+                # indexes on shadow tables are always built after the load, since nothing is reading them yet
+                create_indexes = not self.defer_indexes and not swap
+                with self.metrics.phase('definition'):
+                    if loader:
+                        deferred_indexes = self.createTableDefinitionFromColumns(loader.sourceColumns(), loader.geometryColumnDefinition(),
+                                                                                 dest_schema, dest_table, create_indexes, load_table)
+                    else:
+                        deferred_indexes = self.createTableDefinition(self.temp_schema, table, dest_schema, dest_table,
+                                                                      create_indexes, load_table)
+                created = True
+                print "Created!"
             else:
-                print 'Append to existing table {}.{}'.format(dest_schema, dest_table)
+                if not append:
+                    with self.metrics.phase('truncate'):
+                        self.db.truncateTable(dest_schema, dest_table)
+                        if self.defer_indexes:
+                            deferred_indexes = self.detachIndexes(dest_schema, dest_table)
+                else:
+                    print 'Append to existing table {}.{}'.format(dest_schema, dest_table)
 
-        assert self.copyData('public', table, dest_schema,
-                             dest_table), 'Could not copy data'
+            rows = self.fillTable(loader, table, dest_schema, dest_table, load_table, deferred_indexes, spatial_order,
+                                  precision)
+            if on_loaded:
+                on_loaded()
 
-        self.db.vacuum(dest_schema, dest_table)
+        with self.metrics.phase('vacuum'):
+            self.db.vacuum(dest_schema, load_table)
 
-        count = self.db.recordCount(dest_schema, dest_table)
-        print 'Copied {} records to destination table'.format(count)
-        assert count > 0, 'No records exist in destination table!'
+        if swap:
+            print 'Swapping shadow table into place'
+            with self.metrics.phase('swap'):
+                with self.db.transaction():
+                    self.db.copyTablePrivileges(dest_schema, dest_table, load_table)
+                    self.db.swapTable(dest_schema, dest_table, load_table)
+
+        if append and not created:
+            return None
+        return rows
+
+    def fillTable(self, loader, table, dest_schema, dest_table, load_table, deferred_indexes, spatial_order=None,
+                  precision=None):
+        """ Copies a layer into load_table, which is either dest_table or a table being built to
+        replace it or a part of it, then builds the deferred indexes and orders the rows as required.
+        Returns the number of rows copied.
+        """
+        # rows can only be sorted while copying from the temporary import table, otherwise the
+        # table is clustered after loading
+        order_by = None
+        cluster = False
+        if spatial_order and (loader or self.db.tableHasColumn(self.temp_schema, table, 'geom')):
+            if spatial_order in self.SPATIAL_ORDER_KEYS and not loader:
+                order_by = self.SPATIAL_ORDER_KEYS[spatial_order]
+            else:
+                cluster = True
+
+        with self.metrics.phase('copy') as p:
+            if loader:
+                rows = loader.load(load_table)
+                assert rows, 'Could not copy data'
+            else:
+                rows = self.copyData(self.temp_schema, table, dest_schema,
+                                     dest_table, load_table, order_by, precision)
+            p['rows'] = rows
+
+        if deferred_indexes:
+            print 'Building indexes'
+            with self.metrics.phase('index'):
+                self.db.createIndexes(dest_schema, load_table, deferred_indexes, self.maintenance_work_mem)
+
+        if cluster:
+            print 'Clustering table on spatial index'
+            with self.metrics.phase('cluster'):
+                if not self.db.clusterTable(dest_schema, load_table, 'geom'):
+                    print 'No spatial index on {}.{}, table not clustered'.format(dest_schema, load_table)
+
+        return rows
+
+    def loadPartition(self, loader, table, dest_schema, dest_table, spatial_order=None, precision=None):
+        """ Loads a layer into its own partition of a partitioned destination table, creating the
+        partitioned table if it doesn't exist. The partition is loaded and indexed as a separate
+        table and then attached, replacing the layer's previous partition, so the other partitions
+        are untouched. Returns the number of rows in the partition.
+        """
+        self.createPartitionedTable(loader, table, dest_schema, dest_table)
+
+        partition = self.partitionTable(dest_table, table)
+        exists = self.db.tableExists(dest_schema, partition)
+        # an existing partition stays attached until its replacement is ready
+        load_table = self.shadowTable(partition) if exists else partition
+        print "Loading into partition {}.{}".format(dest_schema, load_table)
 
-        # Drop temporary table
-        self.db.dropTable('public', table)
+        with self.db.transaction():
+            self.db.dropTable(dest_schema, load_table)
+            with self.metrics.phase('definition'):
+                self.db.createPartition(dest_schema, dest_table, load_table, self.PARTITION_COLUMN, table.lower())
+                indexes = self.partitionIndexes(dest_schema, dest_table, load_table)
+            rows = self.fillTable(loader, table, dest_schema, dest_table, load_table, indexes, spatial_order, precision)
 
+        with self.metrics.phase('vacuum'):
+            self.db.vacuum(dest_schema, load_table)
+
+        print 'Attaching partition {}.{}'.format(dest_schema, partition)
+        with self.metrics.phase('attach'):
+            with self.db.transaction():
+                if exists:
+                    self.db.copyTablePrivileges(dest_schema, partition, load_table)
+                    self.db.detachPartition(dest_schema, dest_table, partition)
+                    self.db.swapTable(dest_schema, partition, load_table)
+                self.db.attachPartition(dest_schema, dest_table, partition, table.lower())
+
+        return rows
+
+    def createPartitionedTable(self, loader, table, dest_schema, dest_table):
+        """ Creates a partitioned destination table from the mappings for a layer, if it doesn't
+        already exist. Returns True if the table was created.
+        """
+        with self.db.transaction():
+            # layers sharing the table may be imported by other processes at the same time
+            self.db.advisoryLock(self.db.encodeTableName(dest_schema, dest_table))
+            if self.db.tableExists(dest_schema, dest_table):
+                assert self.db.tableIsPartitioned(dest_schema, dest_table), \
+                    'Table {}.{} is not partitioned, use --recreate to replace it'.format(dest_schema, dest_table)
+                return False
+
+            print "Creating partitioned table {}.{}".format(dest_schema, dest_table)
+            with self.metrics.phase('definition'):
+                if loader:
+                    self.createTableDefinitionFromColumns(loader.sourceColumns(), loader.geometryColumnDefinition(),
+                                                          dest_schema, dest_table, partition_column=self.PARTITION_COLUMN)
+                else:
+                    self.createTableDefinition(self.temp_schema, table, dest_schema, dest_table,
+                                               partition_column=self.PARTITION_COLUMN)
+        return True
+
+    def partitionIndexes(self, dest_schema, dest_table, partition):
+        """ Returns the definitions of the primary key and spatial index for a partition, matching
+        those of the partitioned table so that they are used when the partition is attached. Any
+        other indexes on the partitioned table are built when the partition is attached.
+        """
+        indexes = [dict(i, name=partition + i['name'][len(dest_table):])
+                   for i in self.db.getIndexDefinitions(dest_schema, dest_table)
+                   if i['constraint'] and i['name'].startswith(dest_table)]
+        if self.db.getGeometryColumnDef(dest_schema, partition, 'geom'):
+            indexes.append(self.db.spatialIndexDefinition(dest_schema, partition, 'geom'))
+        return indexes
+
+    def partitionTable(self, dest_table, table):
+        """ Returns the name of the partition holding a layer's rows in a partitioned destination table """
+        return '{}_{}'.format(dest_table, table.lower())
+
+    def applyDelta(self, table, dest_schema, dest_table, precision=None):
+        """ Updates an existing destination table to match the temporary import table, by inserting,
+        updating and deleting only the rows which differ, matched by ufi. Returns False if the delta
+        could not be applied because the imported ufi values are not unique.
+        """
+        source_cols, dest_cols = self.copyColumns(self.temp_schema, table, dest_schema, dest_table,
+                                                  precision=precision)
+        if self.DELTA_KEY not in dest_cols:
+            return False
+
+        print 'Applying changes to destination table'
+        with self.metrics.phase('delta') as p:
+            changes = self.db.applyDelta(self.temp_schema, table, source_cols, dest_schema, dest_table, dest_cols,
+                                         self.DELTA_KEY)
+            if changes:
+                p.update(changes)
+                p['rows'] = changes['inserted'] + changes['updated'] + changes['deleted']
+        if changes is None:
+            print 'Imported {} values are not unique, reloading whole table'.format(self.DELTA_KEY)
+            return False
+
+        print '{} records inserted, {} updated, {} deleted'.format(
+            changes['inserted'], changes['updated'], changes['deleted'])
+        with self.metrics.phase('vacuum'):
+            self.db.vacuum(dest_schema, dest_table)
         return True
 
+    def mappingsHash(self, path, schema, table):
+        """ Returns a hash of the table and column mappings which apply to a layer """
+        dest_schema, dest_table = self.destTable(schema, table)
+        record_count, fields = source.dbfHeader(source.sidecarFile(path, 'dbf'))
+        used = {'table': self.tableMappingIndex.get((schema.upper(), table.upper()), []),
+                'columns': [self.getMappedColumnDef(dest_schema, dest_table, f.lower()) for f in fields]}
+        precision = self.coordinatePrecision(schema, table)
+        if precision:
+            # layers are imported again when the precision setting changes
+            used['precision'] = precision
+        return hashlib.sha1(json.dumps(used, sort_keys=True)).hexdigest()
+
+    def layerFingerprint(self, path, schema, table, previous=None):
+        """ Calculates the fingerprint of a layer's source files and mappings. Content hashes are
+        only calculated for files whose size or modification time differ from the previous
+        fingerprint, if specified.
+        """
+        files = {}
+        for f in source.layerFiles(path):
+            name = os.path.basename(f).lower()
+            stats = source.fileStats(f)
+            if previous and name in previous['files'] and all(
+                    [previous['files'][name][k] == stats[k] for k in stats.keys()]):
+                stats['sha1'] = previous['files'][name]['sha1']
+            else:
+                stats['sha1'] = source.fileHash(f)
+            files[name] = stats
+
+        return {'files': files, 'mappings': self.mappingsHash(path, schema, table)}
+
+    def currentFingerprint(self, path, schema, table):
+        """ Calculates the fingerprint of a layer, reusing the content hashes of any files which
+        are unchanged since the layer was last imported
+        """
+        return self.layerFingerprint(path, schema, table, self.manifest.fingerprint(schema, table))
+
+    def changedFingerprint(self, path, schema, table, current=None):
+        """ Returns the current fingerprint of a layer if its source files or mappings have changed
+        since it was last imported, or its destination table no longer exists, otherwise None.
+        current is the layer's fingerprint, if it has already been calculated. If only the sizes or
+        modification times of unchanged files differ, they are updated in the manifest so the files
+        aren't hashed again by later runs.
+        """
+        previous = self.manifest.fingerprint(schema, table)
+        if current is None:
+            current = self.layerFingerprint(path, schema, table, previous)
+        if not previous or not self.fingerprintsMatch(current, previous):
+            return current
+        if not self.db.tableExists(*self.destTable(schema, table)):
+            # eg dropped since the import
+            return current
+
+        if current != previous:
+            # eg the files were downloaded again
+            self.manifest.updateFingerprint(schema, table, current)
+        return None
+
+    def fingerprintsMatch(self, current, previous):
+        """ Returns whether two layer fingerprints have the same mappings and file contents, regardless
+        of the files' sizes and modification times
+        """
+        if current['mappings'] != previous['mappings']:
+            return False
+        return dict([(n, f['sha1']) for n, f in current['files'].items()]) == \
+            dict([(n, f['sha1']) for n, f in previous['files'].items()])
+
+    def validateTable(self, schema, table, dest_schema, dest_table, stats):
+        """ Checks the rows of a destination table in a single scan, counting the rows, null,
+        empty and invalid geometries and duplicate keys and calculating the extent. Invalid
+        geometries are repaired if make_valid is set. The statistics are added to the stats dict
+        and recorded in the import statistics table. Returns the number of rows.
+        """
+        geom_def = self.db.getGeometryColumnDef(dest_schema, dest_table, 'geom')
+        # uniqueness is only checked when it isn't enforced by a primary key
+        key = None
+        if not self.db.hasPrimaryKey(dest_schema, dest_table) and self.db.tableHasColumn(
+                dest_schema, dest_table, self.DELTA_KEY):
+            key = self.DELTA_KEY
+        stats.update(self.db.tableStatistics(dest_schema, dest_table, 'geom' if geom_def else None, key))
+
+        if stats.get('invalid_geometries'):
+            print '{} invalid geometries in {}.{}'.format(stats['invalid_geometries'], dest_schema, dest_table)
+            if self.make_valid:
+                stats['repaired_geometries'] = self.db.makeValid(dest_schema, dest_table, 'geom', geom_def)
+                print 'Repaired {} geometries'.format(stats['repaired_geometries'])
+                self.db.vacuum(dest_schema, dest_table)
+        if stats.get('duplicate_keys'):
+            print '{} duplicate {} values in {}.{}'.format(stats['duplicate_keys'], key, dest_schema, dest_table)
+
+        self.statistics.record(schema, table, dest_schema, dest_table, stats)
+        return stats['rows']
+
+    def generalizeTable(self, schema, table, dest_schema, dest_table):
+        """ Rebuilds the companion tables for a destination table with its geometries simplified
+        to each of the tolerances in the generalize table mapping option. Existing companion tables
+        are replaced by swapping in a shadow table.
+        """
+        tolerances = self.generalizeTolerances(schema, table)
+        if not tolerances:
+            return
+        geom_def = self.db.getGeometryColumnDef(dest_schema, dest_table, 'geom')
+        if not geom_def:
+            print 'Table {}.{} has no geometry column to generalize'.format(dest_schema, dest_table)
+            return
+
+        with self.metrics.phase('generalize'):
+            for tolerance in tolerances:
+                gen_table = self.generalizedTable(dest_table, tolerance)
+                print 'Generalizing geometries to {}'.format(gen_table)
+                exists = self.db.tableExists(dest_schema, gen_table)
+                build_table = self.shadowTable(gen_table) if exists else gen_table
+                self.db.dropTable(dest_schema, build_table)
+                self.db.createGeneralizedTable(dest_schema, dest_table, build_table, 'geom', geom_def, tolerance)
+                self.db.createIndexes(dest_schema, build_table,
+                                      [self.db.spatialIndexDefinition(dest_schema, build_table, 'geom')],
+                                      self.maintenance_work_mem)
+                self.db.vacuum(dest_schema, build_table)
+                self.db.copyTablePrivileges(dest_schema, dest_table, build_table)
+                if exists:
+                    self.db.swapTable(dest_schema, gen_table, build_table)
+
+    def generalizePartitionedTable(self, schema, table):
+        """ Rebuilds the generalized tables for the partitioned destination table of a layer. This
+        is done once for the whole table after its layers have been loaded, rather than after each
+        layer, since the layers can be loaded by separate processes. Returns the metrics for the build,
+        or None if the table isn't generalized.
+        """
+        if not self.generalizeTolerances(schema, table):
+            return None
+        dest_schema, dest_table = self.destTable(schema, table)
+        print '\n\nGeneralizing partitioned table {}.{}\n-------------'.format(dest_schema, dest_table)
+        self.metrics.startLayer(dest_schema, dest_table, None, 'generalize')
+        try:
+            self.generalizeTable(schema, table, dest_schema, dest_table)
+        except:
+            self.metrics.finishLayer('failed', output=self.metrics_file)
+            raise
+        return self.metrics.finishLayer('generalized', output=self.metrics_file)
+
+    def buildJoin(self, join_map):
+        """ Builds the table for a join mapping, which joins destination tables (eg layers and the
+        VMREFTAB lookup tables for their coded columns) so that queries don't need to. The table is only
+        rebuilt if it doesn't exist, its mapping has changed or one of its source tables has been
+        imported since it was last built. An existing table is replaced by swapping in a shadow table.
+        Returns the metrics for the build, or None if the table is up to date.
+        """
+        dest_schema, dest_table = join_map['dest_schema'], join_map['join']
+        name = '{}.{}'.format(dest_schema, dest_table)
+        sources = self.joinSources(join_map)
+        for schema, table in sources:
+            if not self.db.tableExists(schema, table):
+                print 'Skipping join {}, table {}.{} does not exist'.format(name, schema, table)
+                return None
+
+        exists = self.db.tableExists(dest_schema, dest_table)
+        fingerprint = self.joinFingerprint(join_map, sources)
+        if exists and not self.force and self.manifest.fingerprint(self.JOIN_DATASET, name) == fingerprint:
+            print 'Skipping unchanged join {}'.format(name)
+            return None
+
+        print '\n\nBuilding join {}\n-------------'.format(name)
+        # joins are recorded separately from the layers of the run
+        metrics = Metrics()
+        metrics.startLayer(dest_schema, dest_table, None, 'join')
+        build_table = self.shadowTable(dest_table) if exists else dest_table
+        try:
+            with self.db.transaction():
+                self.db.dropTable(dest_schema, build_table)
+                with metrics.phase('join') as p:
+                    rows = self.db.createTableAs(dest_schema, build_table, self.joinSql(join_map))
+                    p['rows'] = rows
+                indexes = []
+                if join_map.get('key'):
+                    indexes.append(self.db.primaryKeyDefinition(build_table, join_map['key']))
+                if self.db.getGeometryColumnDef(dest_schema, build_table, 'geom'):
+                    indexes.append(self.db.spatialIndexDefinition(dest_schema, build_table, 'geom'))
+                with metrics.phase('index'):
+                    self.db.createIndexes(dest_schema, build_table, indexes, self.maintenance_work_mem)
+                if join_map.get('title'):
+                    self.db.setTableComment(dest_schema, build_table, join_map['title'])
+
+            with metrics.phase('vacuum'):
+                self.db.vacuum(dest_schema, build_table)
+
+            if exists:
+                with metrics.phase('swap'):
+                    with self.db.transaction():
+                        self.db.copyTablePrivileges(dest_schema, dest_table, build_table)
+                        self.db.swapTable(dest_schema, dest_table, build_table)
+        except:
+            metrics.finishLayer('failed', output=self.metrics_file)
+            raise
+
+        print 'Joined {} records'.format(rows)
+        self.manifest.record(self.JOIN_DATASET, name, dest_schema, dest_table, fingerprint)
+        return metrics.finishLayer('joined', rows, self.metrics_file)
+
+    def joinSources(self, join_map):
+        """ Returns the (schema, table) of each destination table used by a join mapping """
+        return [(s['schema'], s['table']) for s in [join_map['from']] + join_map.get('joins', [])]
+
+    def joinSql(self, join_map):
+        """ Returns the query selecting the rows of a join mapping """
+        def source(s):
+            table = self.db.encodeTableName(s['schema'], s['table'])
+            return '{} AS {}'.format(table, s['alias']) if s.get('alias') else table
+
+        sql = 'SELECT {} FROM {}'.format(','.join(join_map.get('columns', ['*'])), source(join_map['from']))
+        for j in join_map.get('joins', []):
+            sql += ' {} JOIN {} ON {}'.format(j.get('type', 'inner').upper(), source(j), j['on'])
+        return sql
+
+    def joinFingerprint(self, join_map, sources):
+        """ Returns the fingerprint of a join mapping and the last imports of its source tables,
+        which changes whenever the join needs to be rebuilt
+        """
+        return {'mappings': hashlib.sha1(json.dumps(join_map, sort_keys=True)).hexdigest(),
+                'sources': dict([('{}.{}'.format(schema, table), str(self.manifest.lastImported(schema, table)))
+                                 for schema, table in sources])}
+
+    def generalizedTable(self, dest_table, tolerance):
+        """ Returns the name of the companion table holding geometries simplified to a tolerance """
+        return '{}_gen{}'.format(dest_table, str(tolerance).replace('.', '_'))
+
+    def encodeDictionaryColumns(self, table, dest_schema, dest_table):
+        """ Makes sure the enum types for the dictionary encoded columns of a layer include all of
+        the values in its temporary import table, creating the types if required
+        """
+        columns = []
+        for c in self.db.getTableColumnDefs(self.temp_schema, table):
+            matched_map = self.getMappedColumnDef(dest_schema, dest_table, c['name'])
+            if matched_map and matched_map.get('dictionary'):
+                columns.append(matched_map)
+        if not columns:
+            return
+
+        with self.metrics.phase('dictionary'):
+            values = self.db.distinctValues(self.temp_schema, table,
+                                            [self.dictionaryValue(m) for m in columns])
+            for m, column_values in zip(columns, values):
+                self.db.updateEnumType(self.DICTIONARY_SCHEMA, m['column_name'], column_values)
+
+    def dictionaryValue(self, matched_map):
+        """ Returns an expression for the text value of a dictionary encoded column, with
+        empty strings treated as nulls
+        """
+        return "NULLIF(({})::text, '')".format(self.sourceExpression(matched_map))
+
+    def dictionaryType(self, matched_map):
+        """ Returns the enum type used for a dictionary encoded column """
+        return self.db.encodeTableName(self.DICTIONARY_SCHEMA, matched_map['column_name'])
+
+    def shadowTable(self, dest_table):
+        """ Returns the name of the shadow table used to load a destination table before swapping it into place """
+        return '{}_shadow'.format(dest_table)
+
+    def detachIndexes(self, dest_schema, dest_table):
+        """ Drops the indexes from a table before bulk loading it. Returns the definitions of the
+        dropped indexes, so that they can be rebuilt once the load is complete.
+        """
+        if self.db.tableIsReferenced(dest_schema, dest_table):
+            print 'Table {}.{} is referenced by foreign keys, indexes will not be deferred'.format(dest_schema, dest_table)
+            return []
+
+        indexes = self.db.getIndexDefinitions(dest_schema, dest_table)
+        self.db.dropIndexes(dest_schema, dest_table, indexes)
+        return indexes
+
+    def directLoader(self, path, schema, table, dest_schema, dest_table):
+        """ Returns a DirectLoader for streaming a layer straight into its destination table,
+        or None if the layer can't be loaded directly and must be staged using ogr2ogr instead.
+        """
+        try:
+            from directloader import DirectLoader
+        except ImportError:
+            print 'GDAL/OGR python bindings are not available, staging layer using ogr2ogr'
+            return None
+
+        loader = DirectLoader(self, path, schema, table, dest_schema, dest_table)
+        reason = loader.unsupportedReason()
+        if reason:
+            print 'Cannot load {} directly ({}), staging layer using ogr2ogr'.format(table, reason)
+            return None
+        return loader
+
     def destTable(self, schema, table):
         """ Returns destination schema and table for a given input table """
-        matched_map = [m for m in self.tableMappings if m['dataset'].upper(
-        ) == schema.upper() and m['table'].upper() == table.upper()]
-        if not len(matched_map) == 1:
+        matched_map = self.tableMapping(schema, table)
+        if not matched_map:
             return schema, table
         dest_schema = schema
         dest_table = table
-        if 'dest_table' in matched_map[0].keys():
-            dest_table = matched_map[0]['dest_table']
-        if 'dest_schema' in matched_map[0].keys():
-            dest_schema = matched_map[0]['dest_schema']
+        if 'dest_table' in matched_map.keys():
+            dest_table = matched_map['dest_table']
+        if 'dest_schema' in matched_map.keys():
+            dest_schema = matched_map['dest_schema']
 
         return dest_schema, dest_table
 
     def shouldAppendTable(self, schema, table):
         """ Returns whether a table should be appended to an existing table """
-        matched_map = [m for m in self.tableMappings if m['dataset'].upper(
-        ) == schema.upper() and m['table'].upper() == table.upper()]
-        if not len(matched_map) == 1:
+        matched_map = self.tableMapping(schema, table)
+        if not matched_map:
             return False
-        if 'append' in matched_map[0].keys() and matched_map[0]['append']:
+        if 'append' in matched_map.keys() and matched_map['append']:
             return True
         else:
             return False
 
+    def coordinatePrecision(self, schema, table):
+        """ Returns the grid size in metres to snap a table's coordinates to, from the precision
+        table mapping option or the precision setting, or None to keep the full precision
+        """
+        matched_map = self.tableMapping(schema, table)
+        if matched_map and 'precision' in matched_map.keys():
+            # a precision of 0 or null keeps the full precision, whatever the setting
+            precision = matched_map['precision']
+        else:
+            precision = self.precision
+        if not precision:
+            return None
+        assert precision > 0, 'Invalid precision {} for {}.{}'.format(precision, schema, table)
+        return precision
+
+    def partitionedTable(self, schema, table):
+        """ Returns whether a table is loaded into its own partition of a partitioned destination table """
+        matched_map = self.tableMapping(schema, table)
+        if not matched_map:
+            return False
+        return bool(matched_map.get('partitioned'))
+
     def isMulti(self, schema, table):
         """ Returns whether a table should have MULTI* geometry type """
-        matched_map = [m for m in self.tableMappings if m['dataset'].upper(
-        ) == schema.upper() and m['table'].upper() == table.upper()]
-        if not len(matched_map) == 1:
+        matched_map = self.tableMapping(schema, table)
+        if not matched_map:
             return False
-        if 'force_multi' in matched_map[0].keys() and matched_map[0]['force_multi']:
+        if 'force_multi' in matched_map.keys() and matched_map['force_multi']:
             return True
         else:
             return False
             
+    def spatialOrder(self, schema, table):
+        """ Returns how the rows of a table should be physically ordered ('hilbert', 'geohash' or
+        'cluster'), or None if they should be left in the source order
+        """
+        matched_map = self.tableMapping(schema, table)
+        if not matched_map or not matched_map.get('spatial_order'):
+            return None
+        spatial_order = matched_map['spatial_order']
+        assert spatial_order in self.SPATIAL_ORDER_KEYS or spatial_order == 'cluster', \
+            'Unknown spatial_order {} for {}.{}'.format(spatial_order, schema, table)
+        return spatial_order
+
+    def generalizeTolerances(self, schema, table):
+        """ Returns the list of tolerances, in metres, to build generalized copies of a table's
+        geometries for, or an empty list if no generalized tables are required
+        """
+        matched_map = self.tableMapping(schema, table)
+        if not matched_map:
+            return []
+        return matched_map.get('generalize', [])
+
     def tableTitle(self, schema, table):
         """ Returns the optional title for a table """
-        matched_map = [m for m in self.tableMappings if m['dataset'].upper(
-        ) == schema.upper() and m['table'].upper() == table.upper()]
+        matched_map = self.tableMappingIndex.get((schema.upper(), table.upper()), [])
         try:
             return matched_map[0]['title']
         except:
@@ -120,24 +937,22 @@ class Importer():
         """ Returns whether a table should have a manually created serial primary key field, if so, returns the name
         of the desired ID column.
         """
-        matched_map = [m for m in self.tableMappings if m['dataset'].upper(
-        ) == schema.upper() and m['table'].upper() == table.upper()]
-        if not len(matched_map) == 1:
+        matched_map = self.tableMapping(schema, table)
+        if not matched_map:
             return None
-        if 'create_serial_id' in matched_map[0].keys():
-            return matched_map[0]['create_serial_id']
+        if 'create_serial_id' in matched_map.keys():
+            return matched_map['create_serial_id']
         else:
             return None
 
     def tablePrimaryKey(self, schema, table):
         """ Returns the manually set primary key for a table
         """
-        matched_map = [m for m in self.tableMappings if m['dataset'].upper(
-        ) == schema.upper() and m['table'].upper() == table.upper()]
-        if not len(matched_map) == 1:
+        matched_map = self.tableMapping(schema, table)
+        if not matched_map:
             return None
-        if 'id' in matched_map[0].keys():
-            return matched_map[0]['id']
+        if 'id' in matched_map.keys():
+            return matched_map['id']
         else:
             return None
 
@@ -155,11 +970,14 @@ class Importer():
                         '-f',
                         'PostgreSQL',  # output format PostgreSQL
                         'PG:{}'.format(self.db.ogrString())]  # PG db details
+        # options used when creating the table. The temporary table is unlogged, since it is
+        # rebuilt if anything goes wrong and doesn't need to be written to the WAL
+        layer_args = ['-lco', 'UNLOGGED=YES']
 
         # Work out if table is a shapefile or just a database table
         # do this by checking for a .shp file
         print 'Importing from {}'.format(path)
-        if path[-3:] == 'shp':
+        if path[-3:].lower() == 'shp':
             print 'Uploading shapefile to PostGIS...'
 
             # Determine whether file should be imported as multipolygons/lines
@@ -170,121 +988,257 @@ class Importer():
             # reproject from GDA94 to Vicgrid
             ogr2ogr_args.extend(['-s_srs', 'epsg:4283', '-t_srs', 'epsg:3111'])
 
-            ogr2ogr_args.extend(['-lco',
-                                 'GEOMETRY_NAME=geom',  # geometry column is 'geom', not that rubbish the_geom default
-                                 '-lco',
-                                 # no spatial index for temporary table, it's
-                                 # only temporary and we want fastest copy
-                                 # possible
-                                 'SPATIAL_INDEX=OFF',
-                                 ])
+            layer_args.extend(['-lco',
+                               'GEOMETRY_NAME=geom',  # geometry column is 'geom', not that rubbish the_geom default
+                               '-lco',
+                               # no spatial index for temporary table, it's
+                               # only temporary and we want fastest copy
+                               # possible
+                               'SPATIAL_INDEX=OFF',
+                               ])
         else:
             # dbf file
             print 'Uploading DBF to PostGIS...'
             # no extra arguments required
 
-        ogr2ogr_args.extend([
-            path,  # source table
-            '-nln',
-            '{}.{}'.format(temp_schema, table)]
-        )
+        destination = ['-nln', '{}.{}'.format(temp_schema, table)]
 
-        subprocess.call(ogr2ogr_args)  # run OGR2OGR import
+        chunks = self.layerChunks(path)
+        if chunks:
+            self.importChunksUsingOGR(ogr2ogr_args, layer_args, path, destination, chunks)
+        else:
+            subprocess.call(ogr2ogr_args + layer_args + [path] + destination)  # run OGR2OGR import
+        self.db.invalidateCatalog(temp_schema, table)
 
         return True
 
+    def layerChunks(self, path):
+        """ Returns OGR where clauses splitting a layer into ranges of feature ids, one for each
+        concurrent ogr2ogr process, or None if the layer should be imported by a single process
+        """
+        if self.chunks <= 1:
+            return None
+        dbf = source.sidecarFile(path, 'dbf')
+        if not dbf:
+            return None
+        record_count, fields = source.dbfHeader(dbf)
+        chunks = min(self.chunks, record_count // self.CHUNK_MIN_FEATURES)
+        if chunks <= 1:
+            return None
+
+        size = -(-record_count // chunks)
+        where = ['FID >= {} AND FID < {}'.format(c * size, (c + 1) * size) for c in range(chunks - 1)]
+        # the last range is left open, so no features are missed
+        where.append('FID >= {}'.format((chunks - 1) * size))
+        return where
+
+    def importChunksUsingOGR(self, ogr2ogr_args, layer_args, path, destination, chunks):
+        """ Imports a layer using concurrent ogr2ogr processes, each reading a range of feature ids
+        and appending to the same temporary table
+        """
+        print 'Uploading in {} chunks...'.format(len(chunks))
+
+        # create the empty table first, so the chunks can all append to it
+        if subprocess.call(ogr2ogr_args + layer_args + ['-where', 'FID < 0', path] + destination) != 0:
+            raise Exception('Could not create temporary table for {}'.format(path))
+
+        append_args = [a for a in ogr2ogr_args if a != '-progress'] + ['-append']
+        processes = [subprocess.Popen(append_args + ['-where', where, path] + destination)
+                     for where in chunks]
+        # a failed chunk would silently drop rows, so treat it as a failed import
+        failed = [where for where, p in zip(chunks, processes) if p.wait() != 0]
+        if failed:
+            raise Exception('Import of {} failed for features {}'.format(path, ', '.join(failed)))
+
     def getMappedColumnDef(self, schema, table, column_name):
         """ Maps a source column definition to a target column definition """
 
-        matched_map = [m for m in self.columnMappings if m[
-            'column_name_10'].upper() == column_name.upper()]
-
-        matched_table_overrides = []
-        no_table_overrides = []
-        for m in matched_map:
-            if 'table_names' in m.keys():
-                if table in m['table_names']:
-                    matched_table_overrides.append(m)
-            else:
-                no_table_overrides.append(m)
+        matched_map = self.columnMappingIndex.get(column_name.upper())
+        if not matched_map:
+            return None
 
-        if matched_table_overrides:
-            if len(matched_table_overrides) == 1:
-                return matched_table_overrides[0]
-            else:
-                # Multiple matches
-                return None
+        if table in matched_map['tables']:
+            return matched_map['tables'][table]
         else:
-            if len(no_table_overrides) == 1:
-                return no_table_overrides[0]
-            else:
-                return None
+            return matched_map['default']
+
+    def createTableDefinition(self, temp_schema, temp_table, dest_schema, dest_table, create_indexes=True,
+                              load_table=None, partition_column=None):
+        """ Creates an empty table definition matching a temporary import table """
+
+        columns = [c['name'] for c in self.db.getTableColumnDefs(temp_schema, temp_table)]
+        geom_def = None
+        if 'geom' in columns:
+            geom_def = self.geometryColumnDefinition(
+                temp_schema, temp_table, dest_schema, dest_table)
 
-    def createTableDefinition(self, temp_schema, temp_table, dest_schema, dest_table):
-        """ Creates an empty table definition """
+        column_types = None
+        if self.narrow_types:
+            column_types = self.narrowColumnTypes(temp_schema, temp_table, dest_schema, dest_table)
+            if self.narrow_types != 'apply':
+                column_types = None
+
+        return self.createTableDefinitionFromColumns(columns, geom_def, dest_schema, dest_table, create_indexes,
+                                                     load_table, column_types, partition_column)
+
+    def narrowColumnTypes(self, temp_schema, temp_table, dest_schema, dest_table):
+        """ Profiles the columns of a temporary import table, and works out which mapped numeric
+        or text columns could be stored using a narrower type (integers or dates). The proposed
+        types are printed, and returned as a dict of destination column name to type.
+        """
+        candidates = []
+        for c in self.db.getTableColumnDefs(temp_schema, temp_table):
+            matched_map = self.getMappedColumnDef(dest_schema, dest_table, c['name'])
+            if not matched_map or 'transform' in matched_map.keys() or matched_map.get('dictionary'):
+                continue
+            if self.baseType(matched_map['data_type']) in self.NUMERIC_TYPES + self.TEXT_TYPES:
+                candidates.append(matched_map)
+        if not candidates:
+            return {}
+
+        with self.metrics.phase('profile'):
+            profiles = self.db.columnProfiles(temp_schema, temp_table,
+                                              [self.sourceExpression(m) for m in candidates])
+
+        column_types = {}
+        for m, profile in zip(candidates, profiles):
+            narrowed = self.narrowType(m['data_type'], profile)
+            if narrowed:
+                print 'Column {} could be {} instead of {} ({} values, {:.0%} null, max length {})'.format(
+                    m['column_name'], narrowed, m['data_type'], profile['values'],
+                    1 - float(profile['non_empty']) / profile['rows'] if profile['rows'] else 0, profile['max_length'])
+                column_types[m['column_name']] = narrowed
+        return column_types
+
+    def narrowType(self, data_type, profile):
+        """ Returns the narrowest type which can safely store all of the values in a column
+        profile, or None if the mapped data type should be kept
+        """
+        if not profile['non_empty']:
+            # no values to go on
+            return None
+        base_type = self.baseType(data_type)
+        if base_type in self.TEXT_TYPES and profile['non_empty'] < profile['values']:
+            # empty strings can't be converted
+            return None
+
+        # checked first, since YYYYMMDD dates are also whole numbers
+        if base_type in self.TEXT_TYPES and profile['dates']:
+            return 'date'
+        if profile['integral'] and not (base_type in self.TEXT_TYPES and profile['leading_zeros']):
+            if profile['max_abs'] < 2 ** 31:
+                return 'integer'
+            if profile['max_abs'] < 2 ** 63:
+                return 'bigint'
+        return None
+
+    def baseType(self, data_type):
+        """ Returns a data type without its modifiers, eg 'character varying' for 'character varying(5)' """
+        return data_type.split('(')[0].strip()
+
+    def createTableDefinitionFromColumns(self, columns, geom_def, dest_schema, dest_table, create_indexes=True,
+                                         load_table=None, column_types=None, partition_column=None):
+        """ Creates an empty table definition for a list of source column names.
+        If create_indexes is False, the primary key and spatial index are not created and their
+        definitions are returned instead, so that they can be built after the table is loaded.
+        If load_table is set, the table is created with that name instead of dest_table (eg
+        for shadow tables), using the mappings for dest_table. column_types optionally overrides
+        the mapped data types of destination columns. If partition_column is set, a text column
+        with that name is added and the table is list partitioned on it. The primary key of a
+        partitioned table includes the partition column.
+        """
+        if not load_table:
+            load_table = dest_table
 
-        # get definition of temporary table
         dest_columns = []
         ufi_index = -1
         pk_index = -1
         min_pk_priority = 999
         geom_col = None
         table_primary_key = self.tablePrimaryKey(dest_schema, dest_table)
-        for i, c in enumerate(self.db.getTableColumnDefs(temp_schema, temp_table)):
+        for name in columns:
             extra_defs = ''
 
-            if c['name'] in ('ogc_fid'):
+            if name in ('ogc_fid'):
                 # skip column
                 continue
-            if c['name'] == 'ufi':
-                ufi_index = i - 1
+            if name == 'ufi':
+                ufi_index = len(dest_columns)
 
-            if c['name'] == 'geom':
-                dest_columns.append(['geom', self.geometryColumnDefinition(
-                    temp_schema, temp_table, dest_schema, dest_table), ''])
+            if name == 'geom':
+                dest_columns.append(['geom', geom_def, ''])
                 geom_col = 'geom'
                 continue
 
             matched_map = self.getMappedColumnDef(
-                dest_schema, dest_table, c['name'])
-            assert matched_map, "could not match: {}".format(c)
+                dest_schema, dest_table, name)
+            assert matched_map, "could not match: {}".format(name)
 
-            if table_primary_key and c['name'].upper() == table_primary_key.upper():
-                pk_index = i - 1
+            if table_primary_key and name.upper() == table_primary_key.upper():
+                pk_index = len(dest_columns)
                 min_pk_priority = 0
             elif 'primary_key_priority' in matched_map:
                 current_pk_priority = matched_map['primary_key_priority']
                 if current_pk_priority < min_pk_priority:
                     min_pk_priority = current_pk_priority
-                    pk_index = i - 1
+                    pk_index = len(dest_columns)
 
+            data_type = matched_map['data_type']
+            if matched_map.get('dictionary'):
+                data_type = self.dictionaryType(matched_map)
+            elif column_types and matched_map['column_name'] in column_types:
+                data_type = column_types[matched_map['column_name']]
             dest_columns.append(
-                [matched_map['column_name'], matched_map['data_type'], extra_defs])
+                [matched_map['column_name'], data_type, extra_defs])
 
         create_serial_id = self.addSerialId(dest_schema, dest_table)
         if create_serial_id:
             dest_columns.insert(0, [create_serial_id, 'serial', ''])
             pk_index = 0
+            if ufi_index > -1:
+                ufi_index += 1
 
         assert pk_index > - \
             1, "Could not determine primary key for {}".format(dest_table)
-        dest_columns[pk_index][2] += ' PRIMARY KEY'
+        deferred_indexes = []
+        partition_by = None
+        if partition_column:
+            # unique constraints on a partitioned table must include the partition column, so the
+            # primary key is added as a table constraint
+            dest_columns.append([partition_column, 'text', 'NOT NULL'])
+            partition_by = 'LIST ({})'.format(self.db.encodeColumnName(partition_column))
+            deferred_indexes.append(self.db.primaryKeyDefinition(
+                load_table, [dest_columns[pk_index][0], partition_column]))
+        elif create_indexes:
+            dest_columns[pk_index][2] += ' PRIMARY KEY'
+        else:
+            deferred_indexes.append(self.db.primaryKeyDefinition(
+                load_table, dest_columns[pk_index][0]))
 
         if ufi_index > -1:
             # move ufi to start of list
             dest_columns.insert(0, dest_columns.pop(ufi_index))
 
         assert self.db.createTable(
-            dest_schema, dest_table, dest_columns), "Could not create table {}.{}".format(dest_schema, dest_table)
+            dest_schema, load_table, dest_columns, partition_by), "Could not create table {}.{}".format(dest_schema, load_table)
+        if partition_column and create_indexes:
+            self.db.createIndexes(dest_schema, load_table, deferred_indexes)
+            deferred_indexes = []
             
         # set table comment to title
         title = self.tableTitle(dest_schema, dest_table)
         if title:
-            self.db.setTableComment( dest_schema, dest_table, title )
+            self.db.setTableComment( dest_schema, load_table, title )
 
         if geom_col:
             # Add spatial index
-            self.db.createSpatialIndex(dest_schema, dest_table, geom_col)
+            if create_indexes:
+                self.db.createSpatialIndex(dest_schema, load_table, geom_col)
+            else:
+                deferred_indexes.append(self.db.spatialIndexDefinition(
+                    dest_schema, load_table, geom_col))
+
+        return deferred_indexes
 
     def geometryColumnDefinition(self, temp_schema, temp_table, dest_schema, dest_table):
         """ Calculates the definition for a layer's geometry column """
@@ -292,15 +1246,21 @@ class Importer():
         # Get definition of existing geometry column
         return self.db.getGeometryColumnDef(temp_schema, temp_table, 'geom')
 
-    def copyData(self, temp_schema, temp_table, dest_schema, dest_table):
-        """ Copies the data from the temporary import table to the destination table, applying transforms as required """
+    def copyColumns(self, temp_schema, temp_table, dest_schema, dest_table, load_table=None, precision=None):
+        """ Returns the list of source expressions and matching destination columns for copying the
+        data from the temporary import table to the destination table, applying transforms as required.
+        Geometries are snapped to a grid of size precision, if set.
+        """
+        if not load_table:
+            load_table = dest_table
 
         source_cols = []
         dest_cols = []
+        dest_types = dict([(d['name'], d['type']) for d in self.db.getTableColumnDefs(dest_schema, load_table)])
 
         for c in self.db.getTableColumnDefs(temp_schema, temp_table):
             if c['name'] == 'geom':
-                source_cols.append('geom')
+                source_cols.append(self.geometryExpression(precision))
                 dest_cols.append('geom')
                 continue
 
@@ -311,17 +1271,64 @@ class Importer():
                 continue
 
             # does mapped column exist in destination?
-            if not self.db.tableHasColumn(dest_schema, dest_table, matched_map['column_name']):
+            if not self.db.tableHasColumn(dest_schema, load_table, matched_map['column_name']):
                 # column not in destination table, ignore
                 continue
 
-            if 'transform' in matched_map.keys():
-                transform = matched_map['transform']
-            else:
-                transform = '"{}"::{}'.format(
-                    c['name'], matched_map['data_type'])
+            transform = self.sourceExpression(matched_map)
+            if matched_map.get('dictionary') and dest_types[matched_map['column_name']].split('.')[-1] == matched_map['column_name']:
+                # column uses the enum type for a dictionary encoded column, tables created
+                # before the column was dictionary encoded keep their original type
+                transform = '{}::{}'.format(self.dictionaryValue(matched_map), self.dictionaryType(matched_map))
+            elif 'transform' not in matched_map.keys():
+                transform = self.narrowedExpression(matched_map, dest_types[matched_map['column_name']])
             source_cols.append(transform)
             dest_cols.append(matched_map['column_name'])
 
+        return source_cols, dest_cols
+
+    def geometryExpression(self, precision=None):
+        """ Returns the expression for loading the geometry column of the temporary import table,
+        with the coordinates snapped to a grid of size precision if set
+        """
+        if not precision:
+            return 'geom'
+        # ST_SnapToGrid also drops consecutive vertices which snap to the same point
+        return 'ST_SnapToGrid(geom, {})'.format(repr(float(precision)))
+
+    def narrowedExpression(self, matched_map, dest_type):
+        """ Returns the expression for loading a mapped column into a destination column whose
+        type was narrowed from the mapped data type, or the plain source expression if it wasn't
+        """
+        expression = self.sourceExpression(matched_map)
+        if dest_type not in self.NARROWED_TYPES or matched_map['data_type'] in self.NARROWED_TYPES[dest_type]:
+            return expression
+        if dest_type in ('integer', 'bigint'):
+            # fails instead of rounding any fractional values
+            return 'vicmap.narrow_{}(({})::numeric)'.format(dest_type, expression)
+        if dest_type == 'date':
+            # fails instead of reading other forms of dates using the DateStyle setting
+            return 'vicmap.narrow_date(({})::text)'.format(expression)
+        return '({})::{}'.format(expression, dest_type)
+
+    def sourceExpression(self, matched_map):
+        """ Returns the expression for a mapped column's value in the temporary import table """
+        if 'transform' in matched_map.keys():
+            return matched_map['transform']
+        return '"{}"::{}'.format(matched_map['column_name_10'].lower(), matched_map['data_type'])
+
+    def copyData(self, temp_schema, temp_table, dest_schema, dest_table, load_table=None, order_by=None,
+                 precision=None):
+        """ Copies the data from the temporary import table to the destination table, applying transforms as required.
+        If load_table is set the data is copied into that table instead of dest_table, using the mappings for dest_table.
+        order_by is an optional expression on the temporary table's columns to sort the rows by, and precision
+        is an optional grid size to snap coordinates to. Returns the number of rows copied.
+        """
+        if not load_table:
+            load_table = dest_table
+
+        source_cols, dest_cols = self.copyColumns(temp_schema, temp_table, dest_schema, dest_table, load_table,
+                                                  precision)
+
         print 'Copying data to destination table'
-        return self.db.copyData(temp_schema, temp_table, source_cols, dest_schema, dest_table, dest_cols)
+        return self.db.copyData(temp_schema, temp_table, source_cols, dest_schema, load_table, dest_cols, order_by)
@@ -0,0 +1,61 @@
+#!python
+
+import json
+
+
+class Journal():
+    """ Records the progress of each layer through an import run, so that an interrupted
+    run can be resumed from the first unfinished layer
+    """
+
+    SCHEMA = 'vicmap'
+    TABLE = 'import_journal'
+
+    # Phases recorded for a layer
+    STAGED = 'staged'
+    DONE = 'done'
+
+    def __init__(self, db):
+        self.db = db
+
+    def entry(self, dataset, layer):
+        """ Returns the journal entry for a layer as a dict, or None if there is no entry """
+        r = self.db.fetchSqlRecords(
+            "SELECT phase, staging_schema, fingerprint FROM {} WHERE dataset='{}' AND layer='{}'".format(
+                self.db.encodeTableName(self.SCHEMA, self.TABLE), self.db.encodeLiteral(dataset), self.db.encodeLiteral(layer)))
+        if not r:
+            return None
+        return {'phase': r[0][0],
+                'staging_schema': r[0][1],
+                'fingerprint': json.loads(r[0][2]) if r[0][2] else None}
+
+    def completedLayers(self):
+        """ Returns a dict of (dataset, layer) to the fingerprint each completely imported layer was
+        imported with
+        """
+        r = self.db.fetchSqlRecords(
+            "SELECT dataset, layer, fingerprint FROM {} WHERE phase='{}'".format(
+                self.db.encodeTableName(self.SCHEMA, self.TABLE), self.DONE))
+        return dict(((dataset, layer), json.loads(fingerprint) if fingerprint else None)
+                    for dataset, layer, fingerprint in r)
+
+    def record(self, dataset, layer, phase, staging_schema=None, fingerprint=None):
+        """ Records that a layer has completed a phase """
+        table = self.db.encodeTableName(self.SCHEMA, self.TABLE)
+        dataset = self.db.encodeLiteral(dataset)
+        layer = self.db.encodeLiteral(layer)
+        return self.db.runSql(
+            "DELETE FROM {0} WHERE dataset='{1}' AND layer='{2}';"
+            "INSERT INTO {0} (dataset, layer, phase, staging_schema, fingerprint) VALUES ('{1}', '{2}', '{3}', {4}, {5})".format(
+                table, dataset, layer, phase,
+                "'{}'".format(self.db.encodeLiteral(staging_schema)) if staging_schema else 'NULL',
+                "'{}'".format(self.db.encodeLiteral(json.dumps(fingerprint, sort_keys=True))) if fingerprint else 'NULL'))
+
+    def clear(self, layers):
+        """ Removes the entries for a list of (dataset, layer), eg when starting a new run """
+        if not layers:
+            return True
+        return self.db.runSql("DELETE FROM {} WHERE (dataset, layer) IN ({})".format(
+            self.db.encodeTableName(self.SCHEMA, self.TABLE),
+            ','.join(["('{}','{}')".format(self.db.encodeLiteral(d), self.db.encodeLiteral(l))
+                      for d, l in layers])))
@@ -0,0 +1,57 @@
+#!python
+
+import json
+
+
+class Manifest():
+    """ Records a fingerprint of the source files and mappings used for each imported layer,
+    so that unchanged layers can be skipped by later imports
+    """
+
+    SCHEMA = 'vicmap'
+    TABLE = 'import_manifest'
+
+    def __init__(self, db):
+        self.db = db
+
+    def fingerprint(self, dataset, layer):
+        """ Returns the fingerprint recorded for the last import of a layer, or None if
+        the layer has not been imported before
+        """
+        r = self.db.fetchSqlRecords(
+            "SELECT fingerprint FROM {} WHERE dataset='{}' AND layer='{}'".format(
+                self.db.encodeTableName(self.SCHEMA, self.TABLE), self.db.encodeLiteral(dataset), self.db.encodeLiteral(layer)))
+        if not r:
+            return None
+        return json.loads(r[0][0])
+
+    def lastImported(self, dest_schema, dest_table):
+        """ Returns when a destination table was last imported to, or None if no layers
+        have been imported to it
+        """
+        r = self.db.fetchSqlRecords(
+            "SELECT max(imported) FROM {} WHERE dest_schema='{}' AND dest_table='{}'".format(
+                self.db.encodeTableName(self.SCHEMA, self.TABLE), self.db.encodeLiteral(dest_schema),
+                self.db.encodeLiteral(dest_table)))
+        return r[0][0]
+
+    def updateFingerprint(self, dataset, layer, fingerprint):
+        """ Replaces the fingerprint recorded for an imported layer, without changing when it
+        was imported
+        """
+        return self.db.runSql(
+            "UPDATE {} SET fingerprint='{}' WHERE dataset='{}' AND layer='{}'".format(
+                self.db.encodeTableName(self.SCHEMA, self.TABLE),
+                self.db.encodeLiteral(json.dumps(fingerprint, sort_keys=True)),
+                self.db.encodeLiteral(dataset), self.db.encodeLiteral(layer)))
+
+    def record(self, dataset, layer, dest_schema, dest_table, fingerprint):
+        """ Records the fingerprint for a successfully imported layer """
+        table = self.db.encodeTableName(self.SCHEMA, self.TABLE)
+        dataset = self.db.encodeLiteral(dataset)
+        layer = self.db.encodeLiteral(layer)
+        return self.db.runSql(
+            "DELETE FROM {0} WHERE dataset='{1}' AND layer='{2}';"
+            "INSERT INTO {0} (dataset, layer, dest_schema, dest_table, fingerprint) VALUES ('{1}', '{2}', '{3}', '{4}', '{5}')".format(
+                table, dataset, layer, self.db.encodeLiteral(dest_schema), self.db.encodeLiteral(dest_table),
+                self.db.encodeLiteral(json.dumps(fingerprint, sort_keys=True))))
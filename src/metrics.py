@@ -0,0 +1,89 @@
+#!python
+
+from contextlib import contextmanager
+import json
+import time
+
+
+class Metrics():
+    """ Records the time taken by each phase of a layer import, and writes the results as JSON lines """
+
+    def __init__(self):
+        self.record = None
+        # record for the most recently finished layer
+        self.lastRecord = None
+
+    def startLayer(self, dataset, layer, path, record_type='layer'):
+        """ Starts recording the metrics for a layer, or for another table built by the import
+        (eg a join) if record_type is set
+        """
+        self.record = {'type': record_type,
+                       'dataset': dataset,
+                       'layer': layer,
+                       'path': path,
+                       'phases': [],
+                       'started': time.time()}
+
+    @contextmanager
+    def phase(self, name):
+        """ Times a phase of the current layer's import. Yields a dict which extra values
+        (eg row counts) can be added to.
+        """
+        p = {'phase': name}
+        start = time.time()
+        try:
+            yield p
+        finally:
+            p['seconds'] = round(time.time() - start, 3)
+            if self.record is not None:
+                self.record['phases'].append(p)
+
+    def addPhase(self, p):
+        """ Adds a phase which was timed separately, eg by another Metrics instance, to the current layer """
+        self.record['phases'].append(p)
+
+    def finishLayer(self, status, rows=None, output=None):
+        """ Finishes recording the metrics for the current layer and writes them to output,
+        which is the path to a metrics file or None for stdout. Returns the layer record.
+        """
+        record = self.record
+        self.record = None
+        record['status'] = status
+        record['seconds'] = round(time.time() - record.pop('started'), 3)
+        if rows is not None:
+            record['rows'] = rows
+        for p in record['phases']:
+            # throughput is only calculated for the phases which process rows, using their own row counts
+            if p.get('rows') is not None and p['seconds'] > 0:
+                p['rows_per_sec'] = round(p['rows'] / p['seconds'], 1)
+        self.write(record, output)
+        self.lastRecord = record
+        return record
+
+    def summary(self, records, skipped, seconds, output=None):
+        """ Writes a summary of a run from the records of the imported layers. seconds is the
+        elapsed time for the whole run.
+        """
+        phases = {}
+        for r in records:
+            for p in r['phases']:
+                phases[p['phase']] = round(phases.get(p['phase'], 0) + p['seconds'], 3)
+        summary = {'type': 'summary',
+                   'layers': len(records),
+                   'failed': len([r for r in records if r['status'] == 'failed']),
+                   'skipped': skipped,
+                   'rows': sum([r.get('rows', 0) for r in records]),
+                   'seconds': round(seconds, 3),
+                   'layer_seconds': round(sum([r['seconds'] for r in records]), 3),
+                   'phase_seconds': phases}
+        self.write(summary, output)
+        return summary
+
+    def write(self, record, output=None):
+        """ Writes a record as a JSON line """
+        line = json.dumps(record, sort_keys=True)
+        if output:
+            with open(output, 'a') as f:
+                f.write(line + '\n')
+        else:
+            print line
@@ -0,0 +1,345 @@
+#!python
+
+from database import Database
+from importer import Importer
+import multiprocessing
+import threading
+import traceback
+import Queue
+import cProfile
+import time
+import os
+
+
+# Importer used by the current worker process, created by initWorker
+worker_importer = None
+
+
+def initWorker(settings, counter):
+    """ Sets up a worker process with its own database connection and temporary schema """
+    global worker_importer
+
+    with counter.get_lock():
+        counter.value += 1
+        worker_id = counter.value
+
+    worker_importer = Importer(Database(), settings.get('mapping_cache'))
+    worker_importer.applySettings(settings)
+    if not worker_importer.skip_shape_import:
+        # Give each worker its own namespace for the temporary import tables
+        worker_importer.temp_schema = Scheduler.workerSchema(worker_id)
+        worker_importer.db.createSchema(worker_importer.temp_schema)
+
+
+def importGroup(group):
+    """ Imports a group of layers inside a worker process. Returns the metrics for the imported
+    layers. If a layer fails the remaining layers in the group are skipped, and the failed layer
+    is also returned along with a formatted traceback.
+    """
+    records = []
+    for idx, total, l in group:
+        try:
+            records.append(Scheduler.importLayer(worker_importer, idx, total, l))
+        except Exception:
+            records.append(worker_importer.metrics.lastRecord)
+            return records, l, traceback.format_exc()
+    return records, None, None
+
+
+class Scheduler():
+    """ Runs the import of a list of layers, optionally across a pool of worker processes """
+
+    def __init__(self, importer, jobs=1, pipeline=0):
+        """ pipeline is the number of layers which can be staged ahead of the layer being loaded
+        when importing serially, or 0 to stage and load each layer in turn
+        """
+        self.importer = importer
+        self.jobs = jobs
+        self.pipeline = pipeline
+
+    @staticmethod
+    def workerSchema(worker_id):
+        """ Returns the name of the temporary schema used by a worker process """
+        return 'vicmap2pgsql_worker_{}'.format(worker_id)
+
+    @staticmethod
+    def importLayer(importer, idx, total, l, staged=None):
+        """ Imports a single layer from the list of layers, profiling the import if required.
+        staged is the staging phase metrics if the layer has already been staged.
+        Returns the metrics for the layer.
+        """
+        print "\n\nImporting {}/{}: {}\n-------------".format(idx + 1, total, l['layer'])
+        layer = Scheduler.layerName(l)
+
+        # fingerprints calculated while checking for changes are reused by the import
+        fingerprint = l.get('fingerprint')
+        if not importer.profile_dir:
+            return importer.importLayer(l['layer'], l['dataset'], layer, staged, fingerprint)
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(importer.importLayer, l['layer'], l['dataset'], layer, staged, fingerprint)
+        finally:
+            if not os.path.isdir(importer.profile_dir):
+                os.makedirs(importer.profile_dir)
+            profiler.dump_stats(os.path.join(importer.profile_dir, '{}.{}.prof'.format(l['dataset'], layer)))
+
+    @staticmethod
+    def layerName(l):
+        """ Returns the name of a layer from the list of layers, which is also the name of its
+        temporary import table. Names are lower case regardless of the case of the source file name.
+        """
+        path, file = os.path.split(l['layer'])
+        return file[:-4].lower()
+
+    def groupLayers(self, layers):
+        """ Splits the layers into groups which must be imported one after the other, since
+        they write to the same destination table (eg appended tables). Layers loaded into their
+        own partition of a partitioned table are grouped by partition instead. Groups are returned
+        in the order their first layer appears in the layer list.
+        """
+        groups = []
+        group_index = {}
+        for idx, l in enumerate(layers):
+            table = self.layerName(l)
+            dest = self.importer.destTable(l['dataset'], table)
+            key = (dest[0].lower(), dest[1].lower())
+            if self.importer.partitionedTable(l['dataset'], table):
+                key += (table,)
+            if key not in group_index:
+                group_index[key] = len(groups)
+                groups.append([])
+            groups[group_index[key]].append((idx, len(layers), l))
+        return groups
+
+    def changedLayers(self, layers):
+        """ Returns the layers which have changed since they were last imported. If any layer written
+        to a destination table has changed, all the layers written to that table are returned, except
+        for partitioned tables where only the changed partitions are reloaded.
+        """
+        changed = []
+        for group in self.groupLayers(layers):
+            for idx, total, l in group:
+                fingerprint = self.importer.changedFingerprint(l['layer'], l['dataset'], self.layerName(l),
+                                                               l.get('fingerprint'))
+                if fingerprint:
+                    l['fingerprint'] = fingerprint
+                    changed.extend([idx for idx, total, l in group])
+                    break
+        return [l for idx, l in enumerate(layers) if idx in changed]
+
+    def run(self, layers):
+        """ Imports all layers, and writes a summary of the run's metrics.
+        Returns a list of (layer, error) for any layers which failed.
+        """
+        start = time.time()
+        skipped = 0
+        run_layers = [(l['dataset'], self.layerName(l)) for l in layers]
+        if self.importer.resume:
+            layers = self.resumableLayers(layers)
+            skipped = len(run_layers) - len(layers)
+        else:
+            # start a new run
+            self.importer.journal.clear(run_layers)
+
+        if not self.importer.force:
+            changed = self.changedLayers(layers)
+            for l in layers:
+                if l not in changed:
+                    print 'Skipping unchanged layer {}: {}'.format(l['dataset'], l['layer'])
+            skipped += len(layers) - len(changed)
+            layers = changed
+
+        records = []
+        try:
+            failures = self.importLayers(layers, records)
+            failures += self.generalizePartitionedTables(layers, failures)
+            if not failures:
+                failures = self.buildJoins()
+            if not failures:
+                # the run is finished, so there's nothing for a later run to resume
+                self.importer.journal.clear(run_layers)
+        finally:
+            self.importer.metrics.summary(records, skipped, time.time() - start, self.importer.metrics_file)
+        return failures
+
+    def resumableLayers(self, layers):
+        """ Returns the layers which weren't completely imported by the interrupted run being resumed.
+        Layers whose source files or mappings have changed since they were imported are imported again.
+        """
+        completed = self.importer.journal.completedLayers()
+        remaining = []
+        for l in layers:
+            previous = completed.get((l['dataset'], self.layerName(l)))
+            if previous:
+                current = self.importer.layerFingerprint(l['layer'], l['dataset'], self.layerName(l), previous)
+                if self.importer.fingerprintsMatch(current, previous):
+                    print 'Skipping layer completed by interrupted run {}: {}'.format(l['dataset'], l['layer'])
+                    continue
+                print 'Layer has changed since it was imported by the interrupted run {}: {}'.format(
+                    l['dataset'], l['layer'])
+                l['fingerprint'] = current
+            remaining.append(l)
+        return remaining
+
+    def generalizePartitionedTables(self, layers, failures):
+        """ Rebuilds the generalized tables of the partitioned destination tables of the imported
+        layers, once per table. Tables with a failed layer are skipped. Returns a list of
+        (layer, error) for any tables which failed.
+        """
+        skip = set(self.importer.destTable(l['dataset'], self.layerName(l)) for l, error in failures)
+        errors = []
+        for l in layers:
+            schema, table = l['dataset'], self.layerName(l)
+            dest = self.importer.destTable(schema, table)
+            if dest in skip or not self.importer.partitionedTable(schema, table):
+                continue
+            skip.add(dest)
+            try:
+                self.importer.generalizePartitionedTable(schema, table)
+            except Exception:
+                error = traceback.format_exc()
+                print "\nGeneralizing {}.{} failed:\n{}".format(dest[0], dest[1], error)
+                errors.append((l, error))
+        return errors
+
+    def buildJoins(self):
+        """ Builds the tables for the join mappings once all layers have been imported.
+        Returns a list of (join, error) for any joins which failed.
+        """
+        failures = []
+        for m in self.importer.joinMappings:
+            try:
+                self.importer.buildJoin(m)
+            except Exception:
+                error = traceback.format_exc()
+                print "\nBuilding join {}.{} failed:\n{}".format(m['dest_schema'], m['join'], error)
+                failures.append(({'dataset': m['dest_schema'], 'layer': m['join']}, error))
+        return failures
+
+    def importLayers(self, layers, records):
+        """ Imports a list of layers, adding the metrics for each layer to records.
+        Returns a list of (layer, error) for any layers which failed.
+        """
+        if self.jobs <= 1 and self.pipeline > 0 and not self.importer.skip_shape_import:
+            return self.importPipelined(layers, records)
+
+        if self.jobs <= 1:
+            for idx, l in enumerate(layers):
+                try:
+                    records.append(self.importLayer(self.importer, idx, len(layers), l))
+                except:
+                    records.append(self.importer.metrics.lastRecord)
+                    raise
+            return []
+
+        if self.pipeline > 0:
+            print "\nPipelined staging is not used with multiple worker processes"
+
+        groups = self.groupLayers(layers)
+        processes = min(self.jobs, len(groups))
+        print "\nImporting {} layers using {} worker processes".format(len(layers), processes)
+
+        failures = []
+        counter = multiprocessing.Value('i', 0)
+        pool = multiprocessing.Pool(processes, initWorker,
+                                    (self.importer.settings(), counter))
+        try:
+            for group_records, l, error in pool.imap_unordered(importGroup, groups):
+                records.extend(group_records)
+                if error:
+                    print "\nImport of {} failed:\n{}".format(l['layer'], error)
+                    failures.append((l, error))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if failures:
+            # keep the temporary import tables of failed layers, so the run can be resumed
+            print "\nTemporary import tables for failed layers have been kept in the worker schemas"
+        elif not self.importer.skip_shape_import:
+            for worker_id in range(1, processes + 1):
+                self.importer.db.dropSchema(
+                    self.workerSchema(worker_id), cascade=True)
+
+        return failures
+
+    def importPipelined(self, layers, records):
+        """ Imports a list of layers one after the other, while the following layers are staged by
+        a separate thread with its own database connection. This overlaps the ogr2ogr imports, which
+        mostly run client side, with the loading, indexing and vacuuming of the previous layers.
+        Up to self.pipeline staged layers wait to be loaded at any time.
+        """
+        stager = Importer(Database(), self.importer.mapping_cache)
+        stager.applySettings(self.importer.settings())
+
+        staged = Queue.Queue(self.pipeline)
+        stop = threading.Event()
+        # names of layers which are staged or being loaded. Layers with the same name share a
+        # temporary import table, so they can't be staged until the previous one is loaded.
+        in_flight = set()
+        in_flight_changed = threading.Condition()
+
+        def stage():
+            try:
+                for idx, l in enumerate(layers):
+                    table = self.layerName(l)
+                    with in_flight_changed:
+                        while table in in_flight and not stop.is_set():
+                            in_flight_changed.wait(1)
+                        in_flight.add(table)
+                    if stop.is_set():
+                        return
+
+                    try:
+                        item = (idx, l, stager.stageLayer(l['layer'], l['dataset'], table, l.get('fingerprint')), None)
+                    except Exception:
+                        item = (idx, l, None, traceback.format_exc())
+
+                    while not stop.is_set():
+                        try:
+                            staged.put(item, timeout=1)
+                            break
+                        except Queue.Full:
+                            pass
+                    if stop.is_set():
+                        if item[2]:
+                            stager.db.dropTable(stager.temp_schema, table)
+                        return
+                    if item[3]:
+                        return
+            finally:
+                stager.db.closeConnection()
+
+        thread = threading.Thread(target=stage)
+        thread.daemon = True
+        thread.start()
+        try:
+            for n in range(len(layers)):
+                idx, l, phase, error = staged.get()
+                if error:
+                    raise Exception('Staging {} failed:\n{}'.format(l['layer'], error))
+                try:
+                    records.append(self.importLayer(self.importer, idx, len(layers), l, phase))
+                except:
+                    records.append(self.importer.metrics.lastRecord)
+                    raise
+                finally:
+                    with in_flight_changed:
+                        in_flight.discard(self.layerName(l))
+                        in_flight_changed.notify_all()
+        finally:
+            stop.set()
+            with in_flight_changed:
+                in_flight_changed.notify_all()
+            thread.join()
+            # drop any layers which were staged but not loaded
+            while not staged.empty():
+                idx, l, phase, error = staged.get()
+                if phase:
+                    self.importer.db.dropTable(self.importer.temp_schema, self.layerName(l))
+
+        return []
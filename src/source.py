@@ -0,0 +1,148 @@
+#!python
+
+from contextlib import contextmanager
+import hashlib
+import os
+import re
+import struct
+import time
+import zipfile
+
+
+# Files making up a shapefile or DBF layer, which contribute to its fingerprint
+SHAPEFILE_EXTENSIONS = ('shp', 'shx', 'dbf', 'prj', 'cpg')
+DBF_EXTENSIONS = ('dbf', 'cpg')
+
+# Prefix for paths to files inside zip archives, read through GDAL's virtual file system
+VSIZIP = '/vsizip/'
+
+
+def zipMember(path):
+    """ Splits a /vsizip/ path into the path of the zip file and the name of the file inside it,
+    or returns None if path isn't inside a zip file
+    """
+    if not path.startswith(VSIZIP):
+        return None
+    path = path[len(VSIZIP):]
+    # the zip file ends at the first .zip followed by a separator, not just any .zip in a folder name
+    m = re.search(r'\.zip[/\\]', path, re.IGNORECASE)
+    if not m:
+        return None
+    end = m.start() + len('.zip')
+    return path[:end], path[end + 1:].replace('\\', '/')
+
+
+def zipLayers(path):
+    """ Returns the layers inside a VicMap zip file as a list of dicts with the dataset and the
+    /vsizip/ path of each layer, finding shapefiles in "layer" folders and DBFs in "table" folders
+    """
+    shapefiles = []
+    tables = []
+    z = zipfile.ZipFile(path)
+    try:
+        for name in z.namelist():
+            parts = name.replace('\\', '/').split('/')
+            if len(parts) < 2:
+                continue
+            folder = parts[-2].lower()
+            extension = parts[-1][-4:].lower()
+            # the dataset is the folder containing the layer and table folders
+            dataset = parts[-3] if len(parts) > 2 else os.path.splitext(os.path.basename(path))[0]
+            layer = {'dataset': dataset.lower(),
+                     'layer': '{}{}/{}'.format(VSIZIP, os.path.abspath(path), name)}
+            if folder == 'layer' and extension == '.shp':
+                shapefiles.append(layer)
+            elif folder == 'table' and extension == '.dbf':
+                tables.append(layer)
+    finally:
+        z.close()
+    return shapefiles + tables
+
+
+def sidecarFile(path, extension):
+    """ Returns the path to a file with the same name as path but a different extension,
+    or None if no such file exists
+    """
+    base = path[:-3]
+    member = zipMember(path)
+    if member:
+        z = zipfile.ZipFile(member[0])
+        try:
+            names = set(z.namelist())
+        finally:
+            z.close()
+        for e in (extension.lower(), extension.upper()):
+            if member[1][:-3] + e in names:
+                return base + e
+        return None
+
+    for e in (extension.lower(), extension.upper()):
+        if os.path.isfile(base + e):
+            return base + e
+    return None
+
+
+@contextmanager
+def openFile(path):
+    """ Opens a file for reading, which may be inside a zip file """
+    member = zipMember(path)
+    if not member:
+        with open(path, 'rb') as f:
+            yield f
+        return
+
+    z = zipfile.ZipFile(member[0])
+    try:
+        f = z.open(member[1])
+        try:
+            yield f
+        finally:
+            f.close()
+    finally:
+        z.close()
+
+
+def layerFiles(path):
+    """ Returns the paths of all existing files making up a layer """
+    extensions = SHAPEFILE_EXTENSIONS if path[-3:].lower() == 'shp' else DBF_EXTENSIONS
+    files = [sidecarFile(path, e) for e in extensions]
+    return [f for f in files if f]
+
+
+def fileHash(path):
+    """ Returns the SHA1 hash of a file's content """
+    h = hashlib.sha1()
+    with openFile(path) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def fileStats(path):
+    """ Returns the size and modification time of a file """
+    member = zipMember(path)
+    if member:
+        z = zipfile.ZipFile(member[0])
+        try:
+            info = z.getinfo(member[1])
+        finally:
+            z.close()
+        return {'size': info.file_size, 'mtime': int(time.mktime(info.date_time + (0, 0, -1)))}
+
+    s = os.stat(path)
+    return {'size': s.st_size, 'mtime': int(s.st_mtime)}
+
+
+def dbfHeader(path):
+    """ Reads the header of a DBF file, returning the number of records and a list of field names """
+    with openFile(path) as f:
+        header = f.read(32)
+        record_count, header_length = struct.unpack('<IH', header[4:10])
+        descriptors = f.read(header_length - 32)
+
+    fields = []
+    for i in range(0, len(descriptors) - 31, 32):
+        if descriptors[i:i + 1] == b'\r':
+            break
+        fields.append(descriptors[i:i + 11].split(b'\0')[0].decode('ascii', 'replace'))
+    return record_count, fields
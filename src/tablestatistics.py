@@ -0,0 +1,25 @@
+#!python
+
+
+class TableStatistics():
+    """ Records the statistics calculated when validating the destination table of each imported
+    layer, keeping a history of the statistics for every import
+    """
+
+    SCHEMA = 'vicmap'
+    TABLE = 'import_statistics'
+
+    # Statistics which are recorded, as returned by Database.tableStatistics and Importer.validateTable
+    COLUMNS = ('rows', 'null_geometries', 'empty_geometries', 'invalid_geometries', 'repaired_geometries',
+               'duplicate_keys', 'extent')
+
+    def __init__(self, db):
+        self.db = db
+
+    def record(self, dataset, layer, dest_schema, dest_table, stats):
+        """ Records the statistics for an imported layer """
+        values = [dataset, layer, dest_schema, dest_table] + [stats.get(c) for c in self.COLUMNS]
+        return self.db.runSql(
+            "INSERT INTO {} (dataset, layer, dest_schema, dest_table, {}) VALUES ({})".format(
+                self.db.encodeTableName(self.SCHEMA, self.TABLE), ', '.join(self.COLUMNS),
+                ', '.join(['NULL' if v is None else "'{}'".format(self.db.encodeLiteral(str(v))) for v in values])))